@@ -40,6 +40,7 @@ setup(
     author="Karoly Lorentey",
     author_email="karoly@lorentey.hu",
     packages=["stagger"],
+    python_requires=">=3.6",
     entry_points = {
         'console_scripts': ['stagger = stagger.commandline:main']
     },
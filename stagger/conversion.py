@@ -30,11 +30,18 @@
 # ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
+import re
+
 from stagger.errors import *
 from warnings import warn
 
 class Unsync:
     "Conversion from/to unsynchronized byte sequences."
+    # A 0xFF byte that needs a sync char after it, and an invalid sync:
+    # the same conditions the generators below test with b & 0xE0.
+    _needs_sync = re.compile(b"\xFF(?=[\x00\x20-\xFF]|\\Z)")
+    _false_sync = re.compile(b"\xFF[\x20-\xFF]")
+
     @staticmethod
     def gen_decode(iterable):
         "A generator for de-unsynchronizing a byte iterable."
@@ -61,31 +68,48 @@ class Unsync:
     @staticmethod
     def decode(data):
         "Remove unsynchronization bytes from data."
-        return bytes(Unsync.gen_decode(data))
+        data = bytes(data)
+        if b"\xFF" not in data:
+            return data
+        if Unsync._false_sync.search(data):
+            warn("Invalid unsynched data", Warning)
+        return data.replace(b"\xFF\x00", b"\xFF")
 
     @staticmethod
     def encode(data):
         "Insert unsynchronization bytes into data."
-        return bytes(Unsync.gen_encode(data))
+        data = bytes(data)
+        if b"\xFF" not in data:
+            return data
+        return Unsync._needs_sync.sub(b"\xFF\x00", data)
 
 class UnsyncReader:
-    "Unsynchronized file reader."
+    """Unsynchronized file reader.
+
+    Reads never consume more of the underlying file than needed: the
+    file is left positioned right after the last byte returned.
+    """
     def __init__(self, file):
         self.file = file
-        self.gen = Unsync.gen_decode(self.__gen_readchar())
-
-    def __gen_readchar(self):
-        try:
-            while True:
-                yield self.file.read(1)[0]
-        except EOFError:
-            pass
+        self.sync = False  # The last byte read from file was 0xFF
 
     def read(self, n):
-        data = bytes(b for i, b in zip(range(n), self.gen))
-        if len(data) < n:
-            raise EOFError
-        return data
+        data = bytearray()
+        while len(data) < n:
+            # Each raw byte decodes to at most one byte, so this never
+            # reads past the data we need.
+            chunk = self.file.read(n - len(data))
+            if not chunk:
+                raise EOFError
+            sync = self.sync
+            self.sync = (chunk[-1] == 0xFF)
+            if sync:
+                if chunk[0] == 0x00:
+                    chunk = chunk[1:]
+                elif chunk[0] & 0xE0:
+                    warn("Invalid unsynched data", Warning)
+            data += Unsync.decode(chunk)
+        return bytes(data)
 
 class Syncsafe:
     """Conversion to/from syncsafe integers.
@@ -129,11 +153,7 @@ class Int8:
     @staticmethod
     def decode(data):
         "Decodes an 8-bit big-endian integer of any length"
-        value = 0
-        for b in data:
-            value <<= 8
-            value += b
-        return value
+        return int.from_bytes(data, "big")
 
     @staticmethod
     def encode(i, *, width=-1):
@@ -142,12 +162,7 @@ class Int8:
         if i is None:
             i = 0
         if i < 0: raise ValueError("Nonnegative integer expected")
-        data = bytearray()
-        while i:
-            data.append(i & 255)
-            i >>= 8
-        if width > 0 and len(data) > width:
+        length = max((i.bit_length() + 7) // 8, abs(width))
+        if width > 0 and length > width:
             raise ValueError("Integer too large")
-        if len(data) < abs(width):
-            data.extend([0] * (abs(width) - len(data)))
-        return bytes(data[::-1])
+        return i.to_bytes(length, "big")
@@ -33,13 +33,21 @@
 """File manipulation utilities."""
 
 import io
+import os
 import os.path
+import errno
 import shutil
 import tempfile
 import signal
+import threading
 
 from contextlib import contextmanager
 
+try:
+    import mmap
+except ImportError:
+    mmap = None
+
 def xread(file, length):
     "Read exactly length bytes from file; raise EOFError if file ends sooner."
     data = file.read(length)
@@ -47,40 +55,89 @@ def xread(file, length):
         raise EOFError
     return data
 
-@contextmanager
-def opened(filename, mode):
-    "Open filename, or do nothing if filename is already an open file object"
-    if isinstance(filename, str):
-        file = open(filename, mode)
-        try: 
-            yield file
-        finally: 
-            if not file.closed:
-                file.close()
-    else:
-        yield filename
+# Buffer size for reading tags.  Tag parsing does many small reads
+# (frame headers), so a large buffer saves system calls.
+_READ_BUFFER_SIZE = 64 * 1024
+
+class opened:
+    """Open filename, or do nothing if filename is already an open file object.
+
+    Unbuffered file objects opened for reading are wrapped in a
+    BufferedReader for the duration of the context; on exit the raw
+    file is positioned after the last byte actually consumed.
+    """
+    __slots__ = ("file", "owned", "raw")
+
+    def __init__(self, filename, mode):
+        self.owned = isinstance(filename, str)
+        self.raw = None
+        if self.owned:
+            buffering = _READ_BUFFER_SIZE if mode == "rb" else -1
+            self.file = open(filename, mode, buffering=buffering)
+        elif mode == "rb" and isinstance(filename, io.RawIOBase):
+            self.raw = filename
+            self.file = io.BufferedReader(filename, _READ_BUFFER_SIZE)
+        else:
+            self.file = filename
+
+    def __enter__(self):
+        return self.file
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.raw is not None and not self.raw.closed:
+            if self.raw.seekable():
+                position = self.file.tell()
+                self.file.detach()
+                self.raw.seek(position)
+            else:
+                self.file.detach()
+        if self.owned and not self.file.closed:
+            self.file.close()
+        return False
+
+# State of suppress_interrupt.  Python only delivers signals to the main
+# thread, so this is only ever touched from there.
+_interrupt_depth = 0
+_interrupt_pending = False
+_interrupt_saved_handler = None
+
+def _deferred_sigint_handler(signum, frame):
+    global _interrupt_pending
+    _interrupt_pending = True
 
 @contextmanager
 def suppress_interrupt():
     """Suppress KeyboardInterrupt exceptions while the context is active.
     
-    The suppressed interrupt (if any) is raised when the context is exited.
-    """
-    interrupted = False
+    The suppressed interrupt (if any) is raised when the outermost
+    context is exited.  Contexts may be nested; the SIGINT handler is
+    only swapped on the outermost level.
 
-    def sigint_handler(signum, frame):
-        nonlocal interrupted
-        interrupted = True
-    
-    s = signal.signal(signal.SIGINT, sigint_handler)
+    KeyboardInterrupt is never raised in threads other than the main
+    thread, so in those the context does nothing.
+    """
+    global _interrupt_depth, _interrupt_pending, _interrupt_saved_handler
+    if threading.current_thread() is not threading.main_thread():
+        yield None
+        return
+    if _interrupt_depth == 0:
+        _interrupt_pending = False
+        _interrupt_saved_handler = signal.signal(signal.SIGINT, 
+                                                 _deferred_sigint_handler)
+    _interrupt_depth += 1
     try:
         yield None
     finally:
-        signal.signal(signal.SIGINT, s)
-    if interrupted:
+        _interrupt_depth -= 1
+        if _interrupt_depth == 0:
+            signal.signal(signal.SIGINT, _interrupt_saved_handler)
+            _interrupt_saved_handler = None
+    if _interrupt_depth == 0 and _interrupt_pending:
+        _interrupt_pending = False
         raise KeyboardInterrupt()
 
-def replace_chunk(filename, offset, length, chunk, in_place=True, max_mem=5):
+def replace_chunk(filename, offset, length, chunk, in_place=True, max_mem=5,
+                  durable=False):
     """Replace length bytes of data with chunk, starting at offset.
     Any KeyboardInterrupts arriving while replace_chunk is runnning
     are deferred until the operation is complete.
@@ -97,69 +154,215 @@ def replace_chunk(filename, offset, length, chunk, in_place=True, max_mem=5):
     If there is no need to move data that is not being replaced, then we use
     the direct method irrespective of in_place.  (In this case an interrupt
     may only corrupt the chunk being replaced.)
+
+    If durable is true, the changes are flushed to stable storage
+    (including the directory entry, when the file is replaced by a
+    copy) before the function returns.  By default we leave this to
+    the operating system.
     """
     with suppress_interrupt():
-        _replace_chunk(filename, offset, length, chunk, in_place, max_mem)
+        _replace_chunk(filename, offset, length, chunk, in_place, max_mem,
+                       durable)
 
-def _replace_chunk(filename, offset, length, chunk, in_place, max_mem):
+def _replace_chunk(filename, offset, length, chunk, in_place, max_mem,
+                   durable):
     assert isinstance(filename, str) or in_place
+    staged = None
     with opened(filename, "rb+") as file:
         # If the sizes match, we can simply overwrite the original data.
         if length == len(chunk):
             file.seek(offset)
             file.write(chunk)
-            return
+        else:
+            oldsize = file.seek(0, 2)
+            newsize = oldsize - length + len(chunk)
 
-        oldsize = file.seek(0, 2)
-        newsize = oldsize - length + len(chunk)
+            if offset + length == oldsize:
+                # If the orig chunk is exactly at the end of the file, we can
+                # simply truncate the file and then append the new chunk.
+                file.seek(offset)
+                file.truncate()
+                file.write(chunk)
+            elif in_place:
+                _replace_chunk_in_place(file, offset, length, chunk, 
+                                        oldsize, newsize, max_mem)
+            else:
+                staged = _stage_replacement(file, filename, offset, length,
+                                            chunk, oldsize, durable)
+        if durable and staged is None:
+            _sync_file(file)
+    if staged is not None:
+        # The original is closed by now, so that the rename doesn't
+        # fail (or get delayed) on systems that lock open files.
+        try:
+            shutil.copymode(filename, staged)
+            os.replace(staged, filename)
+        except BaseException:
+            os.unlink(staged)
+            raise
+        if durable:
+            _sync_dir(os.path.dirname(filename))
 
-        # If the orig chunk is exactly at the end of the file, we can
-        # simply truncate the file and then append the new chunk.
-        if offset + length == oldsize:
-            file.seek(offset)
-            file.truncate()
-            file.write(chunk)
-            return
+def _stage_replacement(file, filename, offset, length, chunk, oldsize,
+                       durable):
+    """Write a copy of file with the chunk replaced into a temporary file
+    next to filename, and return its name."""
+    temp = tempfile.NamedTemporaryFile(dir=os.path.dirname(filename),
+                                       prefix="stagger-",
+                                       suffix=".tmp",
+                                       delete=False)
+    try:
+        with temp:
+            file.seek(0)
+            _copy_chunk(file, temp, offset)
+            temp.write(chunk)
+            file.seek(offset + length)
+            _copy_chunk(file, temp, oldsize - offset - length)
+            if durable:
+                _sync_file(temp)
+    except BaseException:
+        os.unlink(temp.name)
+        raise
+    return temp.name
 
-        if in_place:
-            _replace_chunk_in_place(file, offset, length, chunk, oldsize, newsize)
-        else: # not in_place
-            temp = tempfile.NamedTemporaryFile(dir=os.path.dirname(filename),
-                                               prefix="stagger-",
-                                               suffix=".tmp",
-                                               delete=False)
-            try:
-                file.seek(0)
-                _copy_chunk(file, temp, offset)
-                temp.write(chunk)
-                file.seek(offset + length)
-                _copy_chunk(file, temp, oldsize - offset - length)
-            finally:
-                temp.close()
-                file.close()
-            shutil.copymode(filename, temp.name)
-            shutil.move(temp.name, filename)
-            return
+def _sync_file(file):
+    "Flush file's contents to stable storage."
+    file.flush()
+    os.fsync(file.fileno())
 
+def _sync_dir(dirname):
+    "Flush the directory entries in dirname to stable storage, if possible."
+    try:
+        fd = os.open(dirname or os.curdir, os.O_RDONLY)
+    except OSError:
+        # Directories can't be opened on some systems (Windows).
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
 
 def _copy_chunk(src, dst, length):
     "Copy length bytes from file src to file dst."
-    BUFSIZE = 128 * 1024
+    if length <= 0:
+        return
+    try:
+        srcfd = src.fileno()
+        dstfd = dst.fileno()
+    except (AttributeError, OSError, ValueError):
+        # Not backed by a real file (e.g. io.BytesIO).
+        srcfd = dstfd = None
+    if srcfd is not None:
+        # Let the kernel move the data without a round trip through
+        # Python.  The file objects' positions are resynchronized
+        # afterwards, so buffering is not an issue.
+        dst.flush()
+        srcpos = src.tell()
+        dstpos = dst.tell()
+        copied = 0
+        try:
+            copied = _copy_fd_range(srcfd, dstfd, srcpos, dstpos, length)
+        finally:
+            src.seek(srcpos + copied)
+            dst.seek(dstpos + copied)
+        length -= copied
+    if length <= 0:
+        return
+    BUFSIZE = 1 << 20
+    buf = memoryview(bytearray(min(BUFSIZE, length)))
     while length > 0:
-        l = min(BUFSIZE, length)
-        buf = src.read(l)
-        assert len(buf) == l
-        dst.write(buf)
-        length -= l
+        n = src.readinto(buf[:min(len(buf), length)])
+        if not n:
+            raise EOFError
+        dst.write(buf[:n])
+        length -= n
+
+def _copy_fd_range(srcfd, dstfd, srcpos, dstpos, length):
+    """Copy up to length bytes between file descriptors using zero-copy
+    system calls, where available.  Returns the number of bytes copied;
+    the caller is expected to copy the rest by other means.
+
+    File descriptor offsets are not preserved.
+    """
+    copied = 0
+    if hasattr(os, "copy_file_range"):
+        try:
+            while copied < length:
+                n = os.copy_file_range(srcfd, dstfd, length - copied,
+                                       srcpos + copied, dstpos + copied)
+                if n == 0:
+                    break
+                copied += n
+            return copied
+        except OSError as e:
+            # EXDEV: cross-device copy on older kernels;
+            # ENOSYS, EINVAL, ENOTSUP/EOPNOTSUPP: unsupported file system.
+            if e.errno not in _COPY_FALLBACK_ERRNOS:
+                raise
+    if hasattr(os, "sendfile"):
+        try:
+            os.lseek(dstfd, dstpos + copied, os.SEEK_SET)
+            while copied < length:
+                n = os.sendfile(dstfd, srcfd, srcpos + copied, length - copied)
+                if n == 0:
+                    break
+                copied += n
+        except OSError as e:
+            if e.errno not in _COPY_FALLBACK_ERRNOS:
+                raise
+    return copied
+
+# Errors meaning "this kind of copy is not supported here", after which
+# we fall back to copying through Python.  ENOTSOCK is what sendfile
+# returns on systems (e.g. macOS) that only send to sockets.  Anything
+# else (notably EBADF) points at a bad file object and is raised.
+_COPY_FALLBACK_ERRNOS = frozenset(
+    getattr(errno, name) for name in ("EXDEV", "ENOSYS", "EINVAL", 
+                                      "ENOTSUP", "EOPNOTSUPP", "ENOTSOCK")
+    if hasattr(errno, name))
 
-def _replace_chunk_in_place(file, offset, length, chunk, oldsize, newsize):
+def _extend_file(file, oldsize, newsize):
+    "Grow file from oldsize to newsize bytes, filling the new space with zeros."
+    file.flush()
+    if hasattr(os, "posix_fallocate"):
+        try:
+            # Reserve the blocks in a single call, without pushing 
+            # a buffer of zeros through write().
+            os.posix_fallocate(file.fileno(), oldsize, newsize - oldsize)
+            return
+        except (AttributeError, OSError, ValueError):
+            # Not supported by the file system or the file object.
+            pass
+    file.seek(0, 2)
+    file.write(b"\x00" * (newsize - oldsize))
+
+def _advise_sequential(file, offset, length):
+    "Tell the OS that we're going to sweep through a region of file."
+    if not hasattr(os, "posix_fadvise") or length <= 0:
+        return
+    try:
+        fd = file.fileno()
+        os.posix_fadvise(fd, offset, length, os.POSIX_FADV_SEQUENTIAL)
+        os.posix_fadvise(fd, offset, length, os.POSIX_FADV_WILLNEED)
+    except (AttributeError, OSError, ValueError):
+        # This is just a hint; ignore failures.
+        pass
+
+def _replace_chunk_in_place(file, offset, length, chunk, oldsize, newsize,
+                            max_mem):
+    # Map the file at its largest extent: the old size when shrinking,
+    # the (preallocated) new size when growing.
+    mapsize = max(oldsize, newsize)
     if newsize > oldsize:
-        file.seek(0, 2)
-        file.write(b"\x00" * (len(chunk) - length))
+        _extend_file(file, oldsize, newsize)
     file.seek(0)
     try:
-        import mmap
-        m = mmap.mmap(file.fileno(), max(oldsize, newsize))
+        if mmap is None:
+            raise ImportError("mmap is not available")
+        m = mmap.mmap(file.fileno(), mapsize, access=mmap.ACCESS_WRITE)
+        _advise_sequential(file, offset + length, oldsize - offset - length)
         try:
             m.move(offset + len(chunk), 
                    offset + length, 
@@ -168,20 +371,33 @@ def _replace_chunk_in_place(file, offset, length, chunk, oldsize, newsize):
         finally:
             m.close()
     except (ImportError, EnvironmentError, ValueError):
-        # mmap didn't work.  Let's load the tail into a tempfile
-        # and construct the result from there.
+        # mmap didn't work.  Let's load the tail into memory (or into
+        # a tempfile, if it's too large) and construct the result
+        # from there.
+        tail = oldsize - offset - length
         file.seek(offset + length)
-        temp = tempfile.SpooledTemporaryFile(
-            max_size=max_mem * (1<<20),
-            prefix="stagger-",
-            suffix=".tmp")
+        if tail <= max_mem * (1<<20):
+            buf = bytearray(tail)
+            view = memoryview(buf)
+            pos = 0
+            while pos < tail:
+                n = file.readinto(view[pos:])
+                if not n:
+                    raise EOFError
+                pos += n
+            file.seek(offset)
+            file.truncate()
+            file.write(chunk)
+            file.write(buf)
+            return
+        temp = tempfile.TemporaryFile(prefix="stagger-", suffix=".tmp")
         try:
-            _copy_chunk(file, temp, oldsize - offset - length)
+            _copy_chunk(file, temp, tail)
             file.seek(offset)
             file.truncate()
             file.write(chunk)
             temp.seek(0)
-            _copy_chunk(temp, file, oldsize - offset - length)
+            _copy_chunk(temp, file, tail)
         finally:
             temp.close()
         return
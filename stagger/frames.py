@@ -33,18 +33,141 @@
 """Class definitions for ID3v2 frames."""
 
 import abc
-import collections
-import imghdr
+import collections.abc
+import itertools
+import operator
+import struct
 from abc import abstractmethod
 from warnings import warn
 
 from stagger.errors import *
 from stagger.specs import *
 
-class Frame(metaclass=abc.ABCMeta):
+def _field_encoder(framespec):
+    """Return a function that serializes the attributes of a frame
+    according to FRAMESPEC.  Frame classes store the result in their
+    _encode_fields attribute.
+
+    A leading run of two or more fixed-width fields is packed with a 
+    single precompiled struct.
+    """
+    fields = tuple((spec, spec.name, spec._optional) for spec in framespec)
+
+    def write_fields(frame, fields, parts):
+        for (spec, name, optional) in fields:
+            value = getattr(frame, name)
+            if optional and value is None:
+                break
+            parts.append(spec.write(frame, value))
+        return b"".join(parts)
+
+    fixed = 0
+    while (fixed < len(fields) and not fields[fixed][2]
+           and fields[fixed][0]._struct_format is not None):
+        fixed += 1
+    if fixed < 2:
+        def encode_fields(frame):
+            return write_fields(frame, fields, [])
+        return encode_fields
+
+    packer = struct.Struct(">" + "".join(spec._struct_format 
+                                         for (spec, name, optional) 
+                                         in fields[:fixed]))
+    fixed_values = operator.attrgetter(*(name for (spec, name, optional) 
+                                         in fields[:fixed]))
+    rest = fields[fixed:]
+    def encode_fields(frame):
+        try:
+            head = packer.pack(*fixed_values(frame))
+        except struct.error:
+            # Let the specs deal with unset or out-of-range values.
+            return write_fields(frame, fields, [])
+        return write_fields(frame, rest, [head])
+    return encode_fields
+
+def _version_set(version):
+    """Convert a _version value (a single version number or a collection
+    of them) to a frozenset.  Classes that change _version after creation
+    must update _versions accordingly."""
+    if isinstance(version, collections.abc.Container):
+        return frozenset(version)
+    return frozenset((version,))
+
+class FrameMeta(abc.ABCMeta):
+    """Metaclass for frames.
+
+    Adds a slot for each spec in _framespec that isn't already provided
+    by a base class, so that frame attributes aren't stored in a
+    per-instance dictionary.  Any __slots__ given in the class body are
+    kept.
+
+    The frameid of a frame class is kept apart from the frameid slot
+    of its instances; see the frameid property below.
+    """
+    def __new__(mcls, name, bases, namespace, **kwargs):
+        if "frameid" in namespace:
+            namespace["_class_frameid"] = namespace.pop("frameid")
+        framespec = namespace.get("_framespec")
+        if framespec is None:
+            framespec = next((base._framespec for base in bases 
+                              if hasattr(base, "_framespec")), ())
+        inherited = set()
+        for base in bases:
+            for klass in base.__mro__:
+                inherited.update(klass.__dict__.get("__slots__", ()))
+        slots = list(namespace.get("__slots__", ()))
+        for spec in framespec:
+            if spec.name not in inherited and spec.name not in slots:
+                slots.append(spec.name)
+        namespace["__slots__"] = tuple(slots)
+        return super().__new__(mcls, name, bases, namespace, **kwargs)
+
+    @property
+    def frameid(cls):
+        "The frame id registered for this class (see tags.frameclass)."
+        try:
+            return cls._class_frameid
+        except AttributeError:
+            raise AttributeError("{0} has no frameid".format(cls.__name__)) from None
+
+    @frameid.setter
+    def frameid(cls, value):
+        cls._class_frameid = value
+
+class Frame(metaclass=FrameMeta):
+    # Instances keep a (lazily allocated) __dict__ for attributes that
+    # aren't described by specs, like junkdata or user extensions.
+    __slots__ = ("frameid", "flags", "frameno", "__dict__", "__weakref__")
+
     _framespec = tuple()
+    _spec_by_name = {}        # Maps spec names to specs; set by __init_subclass__
     _version = tuple()
+    _versions = frozenset()   # _version as a set; see _version_set
+    _spec_values = None       # Returns all spec attributes of a frame
+    _repr_fields = ()         # (name, is_binary) pairs for __repr__
+    _decode_ops = ()          # (read_at, name, optional) triples for _decode
+    _str_required = 1         # Number of fields always shown by _str_fields
     _allow_duplicates = False
+    _bozo = False             # Obscure or unreliable frame type
+    _untested = False         # Frame type not verified against real data
+
+    _encode_fields = _field_encoder(_framespec)
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._spec_by_name = {spec.name: spec for spec in cls._framespec}
+        cls._versions = _version_set(cls._version)
+        cls._spec_values = (operator.attrgetter(*cls._spec_by_name)
+                            if cls._spec_by_name else None)
+        cls._repr_fields = tuple((spec.name, isinstance(spec, BinaryDataSpec))
+                                 for spec in cls._framespec)
+        cls._decode_ops = tuple((spec.read_at, spec.name, spec._optional)
+                                for spec in cls._framespec)
+        cls._str_required = 1 + max([0] + [i for (i, spec) 
+                                           in enumerate(cls._framespec)
+                                           if not spec._optional])
+        if "_encode_fields" not in cls.__dict__:
+            cls._encode_fields = _field_encoder(cls._framespec)
     
     def __init__(self, frameid=None, flags=None, frameno=None, **kwargs):
         self.frameid = frameid if frameid else type(self).__name__
@@ -57,33 +180,44 @@ class Frame(metaclass=abc.ABCMeta):
 
     def __setattr__(self, name, value):
         # Automatic validation on assignment
-        for spec in self._framespec:
-            if name == spec.name:
-                value = spec.validate(self, value)
-                break
+        spec = self._spec_by_name.get(name)
+        if spec is not None:
+            value = spec.validate(self, value)
         super().__setattr__(name, value)
 
     def __eq__(self, other):
-        return (isinstance(other, type(self))
+        if self is other:
+            return True
+        if not (isinstance(other, type(self))
                 and self.frameid == other.frameid
                 and self.flags == other.flags
-                and self._framespec == other._framespec
-                and all(getattr(self, spec.name, None) == 
-                        getattr(other, spec.name, None)
-                        for spec in self._framespec))
+                and self._framespec == other._framespec):
+            return False
+        try:
+            return self._spec_values(self) == self._spec_values(other)
+        except (AttributeError, TypeError):
+            # Some spec attributes are unset (or there are no specs).
+            pass
+        return all(getattr(self, spec.name, None) == 
+                   getattr(other, spec.name, None)
+                   for spec in self._framespec)
 
     @classmethod
     def _decode(cls, frameid, data, flags=None, frameno=None):
         frame = cls(frameid=frameid, flags=flags, frameno=frameno)
-        if getattr(frame, "_untested", False):
+        if cls._untested:
             warn("{0}: Untested frame; please verify results".format(frameid),
                  UntestedFrameWarning)
-        for spec in frame._framespec:
+        setter = object.__setattr__
+        offset = 0
+        for (read_at, name, optional) in cls._decode_ops:
             try:
-                val, data = spec.read(frame, data)
-                setattr(frame, spec.name, val)
+                val, offset = read_at(frame, data, offset)
+                # Spec readers produce values that already passed
+                # validation; skip the checks in __setattr__.
+                setter(frame, name, val)
             except EOFError:
-                if not spec._optional:
+                if not optional:
                     raise
         return frame
 
@@ -93,7 +227,13 @@ class Frame(metaclass=abc.ABCMeta):
         assert frame._framespec == cls._framespec
         new = cls(flags=frame.flags, frameno=frame.frameno)
         for spec in cls._framespec:
-            setattr(new, spec.name, getattr(frame, spec.name, None))
+            # The source frame has the same specs, so its attributes
+            # are already validated.  Copy lists so that the two frames
+            # don't share them.
+            value = getattr(frame, spec.name, None)
+            if isinstance(value, list):
+                value = list(value)
+            object.__setattr__(new, spec.name, value)
         return new
 
     @classmethod
@@ -110,14 +250,9 @@ class Frame(metaclass=abc.ABCMeta):
             return frames[0:1]
 
     @classmethod
-    def _in_version(self, *versions):
+    def _in_version(cls, *versions):
         "Returns true if this frame is in any of the specified versions of ID3."
-        for version in versions:
-            if (self._version == version
-                or (isinstance(self._version, collections.Container) 
-                    and version in self._version)):
-                return True
-        return False
+        return not cls._versions.isdisjoint(versions)
 
     def _to_version(self, version):
         if self._in_version(version):
@@ -136,38 +271,33 @@ class Frame(metaclass=abc.ABCMeta):
         #     warn("{0}: Frame type is not widely implemented, "
         #          "its use is discouraged".format(self.frameid), 
         #          BozoFrameWarning)
-        
-        def encode_fields():
-            data = bytearray()
-            for spec in self._framespec:
-                if spec._optional and getattr(self, spec.name) is None:
-                    break
-                data.extend(spec.write(self, getattr(self, spec.name)))
-            return data
-
-        def try_preferred_encodings():
-            orig_encoding = self.encoding
-            try:
-                for encoding in encodings:
-                    try:
-                        self.encoding = encoding
-                        return encode_fields()
-                    except UnicodeEncodeError:
-                        pass
-            finally:
-                self.encoding = orig_encoding
-            raise ValueError("Could not encode strings")
-
         if not isinstance(self._framespec[0], EncodingSpec):
-            return encode_fields()
+            return self._encode_fields()
         elif self.encoding is None:
-            return try_preferred_encodings()
+            return self._encode_preferred(encodings)
         else:
             try:
                 # Try specified encoding before others
-               return encode_fields()
+               return self._encode_fields()
             except UnicodeEncodeError:
-                return try_preferred_encodings()
+                return self._encode_preferred(encodings)
+
+    def _encode_preferred(self, encodings):
+        "Encode fields using the first of ENCODINGS that can represent them."
+        # The encoding is only changed temporarily, so bypass __setattr__.
+        spec = self._framespec[0]
+        orig_encoding = self.encoding
+        try:
+            for encoding in encodings:
+                try:
+                    object.__setattr__(self, "encoding", 
+                                       spec.validate(self, encoding))
+                    return self._encode_fields()
+                except UnicodeEncodeError:
+                    pass
+        finally:
+            object.__setattr__(self, "encoding", orig_encoding)
+        raise ValueError("Could not encode strings")
 
     def __repr__(self):
         stype = type(self).__name__
@@ -176,38 +306,36 @@ class Frame(metaclass=abc.ABCMeta):
             args.append("frameid={0!r}".format(self.frameid))
         if self.flags:
             args.append("flags={0!r}".format(self.flags))
-        for spec in self._framespec:
-            if isinstance(spec, BinaryDataSpec):
-                data = getattr(self, spec.name)
-                if isinstance(data, (bytes, bytearray)):
-                    args.append("{0}=<{1} bytes of binary data {2!r}{3}>".format(
-                            spec.name, len(data), 
-                            data[:20], "..." if len(data) > 20 else ""))
-                else:
-                    args.append(repr(data))
+        for (name, binary) in self._repr_fields:
+            value = getattr(self, name)
+            if not binary:
+                args.append("{0}={1!r}".format(name, value))
+            elif isinstance(value, (bytes, bytearray)):
+                args.append("{0}=<{1} bytes of binary data {2!r}{3}>".format(
+                        name, len(value), 
+                        value[:20], "..." if len(value) > 20 else ""))
             else:
-                args.append("{0}={1!r}".format(spec.name, getattr(self, spec.name)))
+                args.append(repr(value))
         return "{0}({1})".format(stype, ", ".join(args))
 
     def _spec(self, name):
         "Return the named spec."
-        for s in self._framespec:
-            if s.name == name:
-                return s
-        raise ValueError("Unknown spec: " + name)
+        try:
+            return self._spec_by_name[name]
+        except KeyError:
+            raise ValueError("Unknown spec: " + name) from None
 
     def _str_fields(self):
-        fields = []
-        # Determine how many fields to show
-        cutoff = max(i for i in range(len(self._framespec)) 
-                     if i == 0 # don't call max with an the empty sequence
-                     or not self._framespec[i]._optional 
-                     or getattr(self, self._framespec[i].name, None) is not None)
-        for spec in self._framespec[:cutoff + 1]:
-            fields.append("{0}={1}"
-                          .format(spec.name, 
-                                  repr(spec.to_str(getattr(self, spec.name, None)))))
-        return ", ".join(fields)
+        specs = self._framespec
+        values = [getattr(self, spec.name, None) for spec in specs]
+        # Determine how many fields to show: all required ones, plus 
+        # optional ones up to the last one that is set.
+        cutoff = self._str_required
+        for i in range(cutoff, len(specs)):
+            if values[i] is not None:
+                cutoff = i + 1
+        return ", ".join("{0}={1!r}".format(spec.name, spec.to_str(value))
+                         for (spec, value) in zip(specs[:cutoff], values))
         
     def __str__(self):
         flag = " "
@@ -219,6 +347,7 @@ class UnknownFrame(Frame):
     _framespec = (BinaryDataSpec("data"),)
 
 class ErrorFrame(Frame):
+    __slots__ = ("exception",)
     _framespec = (BinaryDataSpec("data"),)
 
     def __init__(self, frameid, data, exception, frameno=None, **kwargs):
@@ -234,24 +363,47 @@ class ErrorFrame(Frame):
         return ", ".join(strs)
     
     
+# Value kinds accepted by TextFrame(), keyed by exact type.
+_TEXT_STR, _TEXT_SEQUENCE, _TEXT_NONE, _TEXT_INVALID = range(4)
+_TEXT_VALUE_KINDS = {
+    str: _TEXT_STR,
+    list: _TEXT_SEQUENCE,
+    tuple: _TEXT_SEQUENCE,
+    type(None): _TEXT_NONE,
+    bytes: _TEXT_INVALID,
+    bytearray: _TEXT_INVALID,
+}
+
 class TextFrame(Frame):
     _framespec = (EncodingSpec("encoding"),
                   SequenceSpec("text", EncodedStringSpec("text")))
 
     def __init__(self, *values, frameid=None, flags=None, frameno=None, **kwargs):
-        def extract_strs(values):
-            if values is None:
-                return
-            if isinstance(values, str):
-                yield values
-            elif isinstance(values, collections.Iterable):
-                for val in values:
-                    for v in extract_strs(val):
-                        yield v
-            else:
-                raise ValueError("Invalid text frame value")
         super().__init__(frameid=frameid, flags=flags, frameno=frameno, **kwargs)
-        self.text.extend(list(extract_strs(values)))
+        # Flatten arbitrarily nested iterables of strings, preserving order.
+        strs = []
+        stack = [values]
+        while stack:
+            value = stack.pop()
+            kind = _TEXT_VALUE_KINDS.get(type(value))
+            if kind is None:
+                # Subclasses and arbitrary iterables.
+                if isinstance(value, str):
+                    kind = _TEXT_STR
+                elif isinstance(value, (bytes, bytearray)):
+                    kind = _TEXT_INVALID
+                elif isinstance(value, collections.abc.Iterable):
+                    value = list(value)
+                    kind = _TEXT_SEQUENCE
+                else:
+                    kind = _TEXT_INVALID
+            if kind == _TEXT_STR:
+                strs.append(value)
+            elif kind == _TEXT_SEQUENCE:
+                stack.extend(reversed(value))
+            elif kind == _TEXT_INVALID:
+                raise ValueError("Invalid text frame value")
+        self.text.extend(strs)
 
     @classmethod
     def _decode(cls, frameid, data, flags=None, frameno=None):
@@ -279,19 +431,21 @@ class TextFrame(Frame):
     def _merge(cls, frames):
         if len(frames) == 1:
             return frames
-        res = cls(text=[])
-        enc = None
-        for f in frames:
-            if enc is None:
-                enc = f.encoding
-            elif enc != f.encoding:
-                enc = False
-            try:
-                res.text.extend(f.text)
-            except KeyError:  # f may be an ErrorFrame here.
-                pass
-        if enc is not False:
-            res.encoding = enc
+        # Some of the frames may be ErrorFrames; skip those.
+        textframes = [f for f in frames if isinstance(f, TextFrame)]
+        if not textframes:
+            return frames[0:1]
+        encodings = set(f.encoding for f in textframes)
+        # The merged values are taken from already validated frames,
+        # so we can bypass __setattr__.
+        res = object.__new__(cls)
+        object.__setattr__(res, "frameid", textframes[0].frameid)
+        object.__setattr__(res, "flags", set())
+        object.__setattr__(res, "frameno", None)
+        object.__setattr__(res, "encoding",
+                           encodings.pop() if len(encodings) == 1 else None)
+        object.__setattr__(res, "text", list(itertools.chain.from_iterable(
+                    f.text for f in textframes)))
         return [res]
 
 class URLFrame(Frame):
@@ -309,6 +463,7 @@ class PictureFrame(Frame):
     def __init__(self, value=None, frameid=None, flags=None, frameno=None, **kwargs):
         super().__init__(frameid=frameid, flags=flags, frameno=frameno, **kwargs)
         if value is not None:
+            import imghdr
             with open(value, "rb") as file:
                 self.data = file.read()
                 self.type = 0
@@ -33,14 +33,27 @@
 """List of frames defined in the various ID3 versions.
 """
 
-import imghdr
-
 import stagger.tags as tags
 from stagger.frames import *
 from stagger.specs import *
 from stagger.tags import frameclass
 
 
+def _image_format(frame):
+    """Guess the format of the image in frame.data using imghdr.
+    The result is remembered on the frame until its data changes."""
+    data = frame.data
+    cached = frame.__dict__.get("_image_format")
+    if cached is not None and cached[0] is data:
+        return cached[1]
+    import imghdr
+    format = imghdr.what(None, data[:32])
+    if isinstance(data, bytes):
+        # Only cache immutable data; bytearrays may change under us.
+        frame.__dict__["_image_format"] = (data, format)
+    return format
+
+
 # ID3v2.4
 
 # 4.2.1. Identification frames
@@ -392,6 +405,9 @@ class RVRB(Frame):
     _untested = True
     _bozo = True
 
+# PIC image formats for the MIME types that ID3v2.2 can represent
+_pic_formats = { "image/jpeg": "JPG", "image/jpg": "JPG", "image/png": "PNG" }
+
 @frameclass
 class APIC(PictureFrame):
     "Attached picture"
@@ -413,16 +429,17 @@ class APIC(PictureFrame):
     def _to_version(self, version):
         if version in (3, 4):
             return self
-        if self.mime.lower() not in ("image/jpeg", "image/jpg", "image/png"):
+        format = _pic_formats.get(self.mime.lower())
+        if format is None:
             raise ValueError("Unsupported image format")
-        return PIC(format="PNG" if self.mime.lower() == "image/png" else "JPG",
+        return PIC(format=format,
                    type=self.type,
                    desc=self.desc,
                    data=self.data)
             
     def _str_fields(self):
-        img = "{0} bytes of {1} data".format(len(self.data), 
-                                             imghdr.what(None, self.data[:32]))
+        img = "{0} bytes of {1} data".format(len(self.data),
+                                             _image_format(self))
         return ("type={0}, desc={1}, mime={2}: {3}"
                 .format(repr(self._spec("type").to_str(self.type)),
                         repr(self.desc),
@@ -673,123 +690,34 @@ class RVAD(Frame):
 
 # ID3v2.2
 
-@frameclass
-class UFI(UFID): pass
-@frameclass
-class TT1(TIT1): pass
-@frameclass
-class TT2(TIT2): pass
-@frameclass
-class TT3(TIT3): pass
-@frameclass
-class TP1(TPE1): pass
-@frameclass
-class TP2(TPE2): pass
-@frameclass
-class TP3(TPE3): pass
-@frameclass
-class TP4(TPE4): pass
-@frameclass
-class TCM(TCOM): pass
-@frameclass
-class TXT(TEXT): pass
-@frameclass
-class TLA(TLAN): pass
-@frameclass
-class TCO(TCON): pass
-@frameclass
-class TAL(TALB): pass
-@frameclass
-class TPA(TPOS): pass
-@frameclass
-class TRK(TRCK): pass
-@frameclass
-class TRC(TSRC): pass
-@frameclass
-class TYE(TYER): pass
-@frameclass
-class TDA(TDAT): pass
-@frameclass
-class TIM(TIME): pass
-@frameclass
-class TRD(TRDA): pass
-@frameclass
-class TMT(TMED): pass
-@frameclass
-class TFT(TFLT): pass
-@frameclass
-class TBP(TBPM): pass
-@frameclass
-class TCR(TCOP): pass
-@frameclass
-class TPB(TPUB): pass
-@frameclass
-class TEN(TENC): pass
-@frameclass
-class TSS(TSSE): pass
-@frameclass
-class TOF(TOFN): pass
-@frameclass
-class TLE(TLEN): pass
-@frameclass
-class TSI(TSIZ): pass
-@frameclass
-class TDY(TDLY): pass
-@frameclass
-class TKE(TKEY): pass
-@frameclass
-class TOT(TOAL): pass
-@frameclass
-class TOA(TOPE): pass
-@frameclass
-class TOL(TOLY): pass
-@frameclass
-class TOR(TORY): pass
-
-@frameclass
-class TXX(TXXX): pass
-
-@frameclass
-class WAF(WOAF): pass
-@frameclass
-class WAR(WOAR): pass
-@frameclass
-class WAS(WOAS): pass
-@frameclass
-class WCM(WCOM): pass
-@frameclass
-class WCP(WCOP): pass
-@frameclass
-class WPB(WPUB): pass
-
-@frameclass
-class WXX(WXXX): pass
-
-@frameclass
-class IPL(IPLS): pass
-
-@frameclass
-class MCI(MCDI): pass
-@frameclass
-class ETC(ETCO): pass
-@frameclass
-class MLL(MLLT): pass
-@frameclass
-class STC(SYTC): pass
-@frameclass
-class ULT(USLT): pass
-@frameclass
-class SLT(SYLT): pass
-
-@frameclass
-class COM(COMM): pass
-
-@frameclass
-class RVA(RVAD): pass
-@frameclass
-class EQU(EQUA): pass
-@frameclass
-class REV(RVRB): pass
+# Most v2.2 frames are the same as their v2.3 counterparts, apart from
+# the three-character frame id.  frameclass links each of these to its
+# base class (see Frame._to_version).
+_v22_aliases = (
+    ("UFI", UFID), ("TT1", TIT1), ("TT2", TIT2), ("TT3", TIT3),
+    ("TP1", TPE1), ("TP2", TPE2), ("TP3", TPE3), ("TP4", TPE4),
+    ("TCM", TCOM), ("TXT", TEXT), ("TLA", TLAN), ("TCO", TCON),
+    ("TAL", TALB), ("TPA", TPOS), ("TRK", TRCK), ("TRC", TSRC),
+    ("TYE", TYER), ("TDA", TDAT), ("TIM", TIME), ("TRD", TRDA),
+    ("TMT", TMED), ("TFT", TFLT), ("TBP", TBPM), ("TCR", TCOP),
+    ("TPB", TPUB), ("TEN", TENC), ("TSS", TSSE), ("TOF", TOFN),
+    ("TLE", TLEN), ("TSI", TSIZ), ("TDY", TDLY), ("TKE", TKEY),
+    ("TOT", TOAL), ("TOA", TOPE), ("TOL", TOLY), ("TOR", TORY),
+    ("TXX", TXXX), ("WAF", WOAF), ("WAR", WOAR), ("WAS", WOAS),
+    ("WCM", WCOM), ("WCP", WCOP), ("WPB", WPUB), ("WXX", WXXX),
+    ("IPL", IPLS), ("MCI", MCDI), ("ETC", ETCO), ("MLL", MLLT),
+    ("STC", SYTC), ("ULT", USLT), ("SLT", SYLT), ("COM", COMM),
+    ("RVA", RVAD), ("EQU", EQUA), ("REV", RVRB), ("GEO", GEOB),
+    ("CNT", PCNT), ("POP", POPM), ("BUF", RBUF), ("CRA", AENC),
+)
+
+for (_name, _base) in _v22_aliases:
+    globals()[_name] = frameclass(type(_base)(_name, (_base,), 
+                                              {"__module__": __name__,
+                                               "__qualname__": _name,
+                                               "frameid": _name,
+                                               "_version": 2}))
+del _name, _base
 
 @frameclass
 class PIC(PictureFrame):
@@ -819,30 +747,21 @@ class PIC(PictureFrame):
         elif self.format.upper() == "JPG":
             mime = "image/jpeg"
         else:
-            mime = imghdr.what(io.StringIO(self.data))
+            mime = _image_format(self)
             if mime is None:
                 raise ValueError("Unknown image format")
             mime = "image/" + mime.lower()
         return APIC(mime=mime, type=self.type, desc=self.desc, data=self.data)
         
     def _str_fields(self):
-        img = "{0} bytes of {1} data".format(len(self.data), 
-                                             imghdr.what(None, self.data[:32]))
+        img = "{0} bytes of {1} data".format(len(self.data),
+                                             _image_format(self))
         return ("type={0}, desc={1}, format={2}: {3}"
                 .format(repr(self._spec("type").to_str(self.type)),
                         repr(self.desc),
                         repr(self.format),
                         img))
 
-@frameclass
-class GEO(GEOB): pass
-@frameclass
-class CNT(PCNT): pass
-@frameclass
-class POP(POPM): pass
-
-@frameclass
-class BUF(RBUF): pass
 @frameclass
 class CRM(Frame):
     "Encrypted meta frame"
@@ -853,9 +772,6 @@ class CRM(Frame):
     _untested = True
     _version = 2
 
-@frameclass
-class CRA(AENC): pass
-
 @frameclass
 class LNK(Frame):
     "Linked information"
@@ -1028,8 +944,19 @@ genres = (
     "Christian Rock", "Merengue", "Salsa", "Thrash Metal", "Anime", "JPop",
     "Synthpop")
 
-__all__ = [ obj.__name__ for obj in globals().values() 
-            if is_frame_class(obj)]
+_genre_index = {name.lower(): i for (i, name) in enumerate(genres)}
+
+def genre_id(name):
+    "Return the ID3v1 genre number for name (ignoring case), or None."
+    return _genre_index.get(name.lower())
+
+def genre_name(genre):
+    "Return the name of ID3v1 genre number genre, or None if it is unknown."
+    return genres[genre] if 0 <= genre < len(genres) else None
+
+# Every frame class above was registered by @frameclass, in definition order.
+__all__ = [ cls.__name__ for cls in tags.Tag.known_frames.values()
+            if cls.__module__ == __name__ ]
 
 tags.Tag.frame_order = tags.FrameOrder(TIT2, TPE1, TALB, TRCK, TPOS, TCOM,
                                        TDRC, TYER, TRDA, TDAT, TIME,
@@ -35,13 +35,14 @@ import string
 from stagger.errors import *
 import stagger.fileutil as fileutil
 
-from stagger.id3 import genres
+from stagger.id3 import genre_id, genre_name
 
 class Tag1():
     @property
     def genre(self):
-        if self._genre < len(genres):
-            return "{0} ({1})".format(self._genre, genres[self._genre])
+        name = genre_name(self._genre)
+        if name is not None:
+            return "{0} ({1})".format(self._genre, name)
         else:
             return "{0} (unknown)".format(self._genre)
 
@@ -60,11 +61,11 @@ class Tag1():
             if value.lower() == "unknown":
                 self._genre = 255
                 return
-            try:
-                self._genre = genres.index(value)
-                return
-            except ValueError:
+            genre = genre_id(value)
+            if genre is None:
                 raise ValueError("Unknown genre")
+            self._genre = genre
+            return
         raise TypeError("Invalid genre")
 
     def __str__(self):
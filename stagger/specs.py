@@ -31,7 +31,10 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 import abc
-import collections
+import codecs
+import collections.abc
+import functools
+import struct
 
 from abc import abstractmethod
 from warnings import warn
@@ -41,19 +44,57 @@ from stagger.errors import *
 
 # The idea for the Spec system comes from Mutagen.
 
+# Common concrete sequence types; cheaper to test than the
+# collections.abc.Sequence ABC.
+_sequence_types = (list, tuple, bytes, bytearray)
+
+def _is_sequence(value):
+    "Return true if value is a non-string sequence."
+    return (isinstance(value, _sequence_types)
+            or (isinstance(value, collections.abc.Sequence)
+                and not isinstance(value, str)))
+
+# str.isascii is O(1), but only exists from Python 3.7.  Without it,
+# treat every string as non-ASCII and let the encoders check it.
+try:
+    _isascii = str.isascii
+except AttributeError:
+    def _isascii(value):
+        return False
+
 def optionalspec(spec):
     spec._optional = True
     return spec
 
 class Spec(metaclass=abc.ABCMeta):
+    __slots__ = ("name", "_optional")
     def __init__(self, name):
         self.name = name
-
-    _optional = False
+        self._optional = False
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # A subclass that overrides read but not read_at must not inherit
+        # a read_at that would bypass its read.
+        if "read" in cls.__dict__ and "read_at" not in cls.__dict__:
+            cls.read_at = Spec.read_at
+
+    # If the encoding of this spec is always a single struct field,
+    # this is its struct format character.  Frames use it to pack runs of
+    # such fields with a single struct call.
+    _struct_format = None
         
     @abstractmethod
     def read(self, frame, data): pass
 
+    def read_at(self, frame, data, offset):
+        """Like read, but start reading at data[offset] and return the
+        offset of the first unread byte instead of the remaining data.
+        Sequences and frames read their fields this way, so that the 
+        rest of the data isn't copied for each value."""
+        value, rest = self.read(frame, data[offset:])
+        return value, len(data) - len(rest)
+
     @abstractmethod
     def write(self, frame, value): pass
 
@@ -65,10 +106,17 @@ class Spec(metaclass=abc.ABCMeta):
         return str(value)
 
 class ByteSpec(Spec):
+    __slots__ = ()
+    _struct_format = "B"
+
     def read(self, frame, data):
         if len(data) < 1:
             raise EOFError()
         return data[0], data[1:]
+    def read_at(self, frame, data, offset):
+        if len(data) <= offset:
+            raise EOFError()
+        return data[offset], offset + 1
     def write(self, frame, value):
         return bytes([value])
     def validate(self, frame, value):
@@ -87,9 +135,21 @@ class IntegerSpec(Spec):
     width from.
     The width is automatically rounded up to the nearest multiple of 8.
     """
+    __slots__ = ("width", "_struct")
+    _struct_formats = {8: "B", 16: "H", 32: "I", 64: "Q"}
+
     def __init__(self, name, width):
         super().__init__(name)
         self.width = width
+        # Precompiled struct for fixed widths with a native format.
+        format = self._struct_format
+        self._struct = struct.Struct(">" + format) if format else None
+
+    @property
+    def _struct_format(self):
+        if isinstance(self.width, str):
+            return None
+        return self._struct_formats.get(self.width)
 
     def _width(self, frame):
         if isinstance(self.width, str):
@@ -98,12 +158,27 @@ class IntegerSpec(Spec):
             return (self.width + 7) // 8
 
     def read(self, frame, data):
-        w = self._width(frame)
-        if len(data) < w:
+        value, offset = IntegerSpec.read_at(self, frame, data, 0)
+        return value, data[offset:]
+
+    def read_at(self, frame, data, offset):
+        st = self._struct
+        if st is not None:
+            end = offset + st.size
+            if len(data) < end:
+                raise EOFError()
+            return st.unpack_from(data, offset)[0], end
+        end = offset + self._width(frame)
+        if len(data) < end:
             raise EOFError()
-        return Int8.decode(data[:w]), data[w:]
+        return int.from_bytes(data[offset:end], "big"), end
 
     def write(self, frame, value):
+        if self._struct is not None:
+            try:
+                return self._struct.pack(value)
+            except struct.error:
+                pass # Let Int8 deal with None and report range errors.
         return Int8.encode(value, width=self._width(frame))
 
     def validate(self, frame, value):
@@ -111,6 +186,12 @@ class IntegerSpec(Spec):
             return value
         if type(value) is not int: 
             raise TypeError("Not an integer: {0}".format(repr(value)))
+        if self._struct is not None:
+            try:
+                self._struct.pack(value)
+                return value
+            except struct.error:
+                pass # Report the specific range error below.
         w = self._width(frame)
         if value < 0:
             raise ValueError("Value is negative")
@@ -125,17 +206,31 @@ class SignedIntegerSpec(IntegerSpec):
     width from.
     The width is automatically rounded up to the nearest multiple of 8.
     """
+    __slots__ = ()
+    _struct_formats = {8: "b", 16: "h", 32: "i", 64: "q"}
+
     def __init__(self, name, width):
         super().__init__(name, width=width)
 
     def read(self, frame, data):
-        w = self._width(frame)
-        (value, data) = super().read(frame, data)
-        if value & (1 << ((w << 3) - 1)): # Negative value
-            value -= (1 << (w << 3))
-        return value, data
+        value, offset = SignedIntegerSpec.read_at(self, frame, data, 0)
+        return value, data[offset:]
+
+    def read_at(self, frame, data, offset):
+        if self._struct is not None:
+            # The struct format is already signed.
+            return super().read_at(frame, data, offset)
+        end = offset + self._width(frame)
+        if len(data) < end:
+            raise EOFError()
+        return int.from_bytes(data[offset:end], "big", signed=True), end
 
     def write(self, frame, value):
+        if self._struct is not None:
+            try:
+                return self._struct.pack(value)
+            except struct.error:
+                pass
         w = self._width(frame)
         if value < 0:
             value += (1 << (w << 3))
@@ -146,6 +241,12 @@ class SignedIntegerSpec(IntegerSpec):
             return value
         if type(value) is not int: 
             raise TypeError("Not an integer")
+        if self._struct is not None:
+            try:
+                self._struct.pack(value)
+                return value
+            except struct.error:
+                pass
         w = self._width(frame)
         if value >= (1 << ((w << 3) - 1)):
             raise ValueError("Value is too large")
@@ -160,16 +261,23 @@ class RVADIntegerSpec(IntegerSpec):
     frame's <signs> attribute.  A zero sign bit indicates
     the value is negative.
     """
+    __slots__ = ("signbit", "signs")
+    _struct_formats = {}   # Sign + magnitude format
+
     def __init__(self, name, width, signbit, signs="signs"):
         super().__init__(name, width)
         self.signbit = signbit
         self.signs = signs
 
     def read(self, frame, data):
-        (value, data) = super().read(frame, data)
+        value, offset = RVADIntegerSpec.read_at(self, frame, data, 0)
+        return value, data[offset:]
+
+    def read_at(self, frame, data, offset):
+        (value, offset) = super().read_at(frame, data, offset)
         if not (getattr(frame, self.signs) & (1 << self.signbit)):
             value *= -1
-        return (value, data)
+        return (value, offset)
 
     def write(self, frame, value):
         return super().write(frame, abs(value))
@@ -195,22 +303,23 @@ class RVADIntegerSpec(IntegerSpec):
         
 
 class VarIntSpec(Spec):
+    __slots__ = ()
     def read(self, frame, data):
-        if len(data) == 0:
+        value, offset = VarIntSpec.read_at(self, frame, data, 0)
+        return value, data[offset:]
+    def read_at(self, frame, data, offset):
+        if len(data) <= offset:
             raise EOFError()
-        bits = data[0]
-        data = data[1:]
-        bytes = (bits + 7) >> 3
-        if len(data) < bytes:
+        bits = data[offset]
+        start = offset + 1
+        end = start + ((bits + 7) >> 3)
+        if len(data) < end:
             raise EOFError()
-        return Int8.decode(data[:bytes]), data[bytes:]
+        return int.from_bytes(data[start:end], "big"), end
     def write(self, frame, value):
-        bytes = 4
-        t = value >> 32
-        while t > 0:
-            t >>= 32
-            bytes += 4
-        return Int8.encode(bytes * 8, width=1) + Int8.encode(value, width=bytes)
+        # Whole 32-bit words, at least one
+        nbytes = max(1, (int.bit_length(value) + 31) >> 5) * 4
+        return Int8.encode(nbytes * 8, width=1) + Int8.encode(value, width=nbytes)
     def validate(self, frame, value):
         if value is None:
             return value
@@ -221,25 +330,36 @@ class VarIntSpec(Spec):
         return value
 
 class BinaryDataSpec(Spec):
+    __slots__ = ()
     def read(self, frame, data):
         return data, bytes()
+    def read_at(self, frame, data, offset):
+        return data[offset:], len(data)
     def write(self, frame, value):
         return bytes(value)
     def validate(self, frame, value):
         if value is None:
             return bytes()
-        if not isinstance(value, collections.ByteString):
+        if not isinstance(value, (bytes, bytearray)):
             raise TypeError("Not a byte sequence")
         return value
     def to_str(self, value):
         return '{0}{1}'.format(value[0:16], "..." if len(value) > 16 else "")
 
 class SimpleStringSpec(Spec):
+    __slots__ = ("length",)
     def __init__(self, name, length):
         super().__init__(name)
         self.length = length
     def read(self, frame, data):
+        if len(data) < self.length:
+            raise EOFError()
         return data[:self.length].decode('latin-1'), data[self.length:]
+    def read_at(self, frame, data, offset):
+        end = offset + self.length
+        if len(data) < end:
+            raise EOFError()
+        return data[offset:end].decode('latin-1'), end
     def write(self, frame, value):
         if value is None:
             return b" " * self.length
@@ -254,17 +374,25 @@ class SimpleStringSpec(Spec):
             raise TypeError("Not a string")
         if len(value) != self.length: 
             raise ValueError("String length mismatch")
-        value.encode('latin-1')
+        if not _isascii(value):
+            value.encode('latin-1')
         return value
 
 class LanguageSpec(SimpleStringSpec):
+    __slots__ = ()
     def __init__(self, name):
         super().__init__(name, 3)
     
 class NullTerminatedStringSpec(Spec):
+    __slots__ = ()
     def read(self, frame, data):
         rawstr, sep, data = data.partition(b"\x00")
         return rawstr.decode('latin-1'), data
+    def read_at(self, frame, data, offset):
+        end = data.find(b"\x00", offset)
+        if end < 0:
+            return data[offset:].decode('latin-1'), len(data)
+        return data[offset:end].decode('latin-1'), end + 1
     def write(self, frame, value):
         return value.encode('latin-1') + b"\x00"
     def validate(self, frame, value):
@@ -272,25 +400,37 @@ class NullTerminatedStringSpec(Spec):
             return ""
         if not isinstance(value, str):
             raise TypeError("Not a string")
-        value.encode('latin-1')
+        if not _isascii(value):
+            value.encode('latin-1')
         return value
 
 class URLStringSpec(NullTerminatedStringSpec):
+    __slots__ = ()
     def read(self, frame, data):
-        rawstr, sep, data = data.partition(b"\x00")
-        if len(rawstr) == 0 and len(data) > 0:
+        value, offset = URLStringSpec.read_at(self, frame, data, 0)
+        return value, data[offset:]
+    def read_at(self, frame, data, offset):
+        if (offset + 1 < len(data) and data[offset] == 0):
             # iTunes prepends an extra null byte to WFED frames (encoding spec?)
             #warn("Frame {0} includes a text encoding byte".format(frame.frameid), Warning)
-            rawstr, sep, data = data.partition(b"\x00")
-        return rawstr.decode('latin-1'), data
+            offset += 1
+        return super().read_at(frame, data, offset)
 
 class EncodingSpec(ByteSpec):
     "EncodingSpec must be the first spec."
+    __slots__ = ()
+    _names = {}   # Cache of encoding names already looked up by validate
+
     def read(self, frame, data):
         enc, data = super().read(frame, data)
         if enc & 0xFC:
             raise FrameError("Invalid encoding")
         return enc, data
+    def read_at(self, frame, data, offset):
+        enc, offset = super().read_at(frame, data, offset)
+        if enc & 0xFC:
+            raise FrameError("Invalid encoding")
+        return enc, offset
     def write(self, frame, value):
         return super().write(frame, value)
     def validate(self, frame, value):
@@ -299,8 +439,13 @@ class EncodingSpec(ByteSpec):
         def norm(s):
             return s.lower().replace("-", "")
         if isinstance(value, str):
+            try:
+                return self._names[value]
+            except KeyError:
+                pass
             for i in range(len(EncodedStringSpec._encodings)):
                 if norm(EncodedStringSpec._encodings[i][0]) == norm(value):
+                    self._names[value] = i
                     value = i
                     break
             else:
@@ -317,68 +462,116 @@ class EncodingSpec(ByteSpec):
         else:
             return EncodedStringSpec._encodings[value][0]
 
+# Per-encoding string readers and writers for EncodedStringSpec.
+# Readers return the decoded string and the offset past its terminator.
+
+def _read_latin1(data, offset):
+    index = data.find(b"\x00", offset)
+    if index < 0:
+        return data[offset:].decode("latin-1"), len(data)
+    return data[offset:index].decode("latin-1"), index + 1
+
+def _read_utf8(data, offset):
+    index = data.find(b"\x00", offset)
+    if index < 0:
+        return data[offset:].decode("utf-8"), len(data)
+    return data[offset:index].decode("utf-8"), index + 1
+
+def _wide_string_end(data, offset):
+    "Find the first double null starting at an even distance from offset."
+    find = data.find
+    index = find(b"\x00\x00", offset)
+    while index > offset and (index - offset) & 1:
+        index = find(b"\x00\x00", index + 1)
+    if index < 0:
+        index = len(data)
+        if (index - offset) & 1:
+            raise EOFError()
+    return index
+
+def _read_utf16(data, offset):
+    index = _wide_string_end(data, offset)
+    return (data[offset:index].decode("utf-16"),
+            min(index + 2, len(data)))
+
+def _read_utf16be(data, offset):
+    # bytes.decode has no fast path for UTF-16BE; call the codec directly.
+    index = _wide_string_end(data, offset)
+    return (codecs.utf_16_be_decode(data[offset:index], None, True)[0],
+            min(index + 2, len(data)))
+
+def _write_latin1(value):
+    return value.encode("latin-1") + b"\x00"
+
+def _write_utf16(value):
+    return value.encode("utf-16") + b"\x00\x00"
+
+def _write_utf16be(value):
+    return codecs.utf_16_be_encode(value)[0] + b"\x00\x00"
+
+def _write_utf8(value):
+    return value.encode("utf-8") + b"\x00"
+
 class EncodedStringSpec(Spec):
+    __slots__ = ()
     _encodings = (('latin-1', b"\x00"),
                   ('utf-16', b"\x00\x00"),
                   ('utf-16-be', b"\x00\x00"),
                   ('utf-8', b"\x00"))
+    # Specialized readers and writers, indexed like _encodings.
+    _readers = (_read_latin1, _read_utf16, _read_utf16be, _read_utf8)
+    _writers = (_write_latin1, _write_utf16, _write_utf16be, _write_utf8)
 
     def read(self, frame, data):
-        enc, term = self._encodings[frame.encoding]
-        if len(term) == 1:
-            rawstr, sep, data = data.partition(term)
-        else:
-            index = len(data)
-            for i in range(0, len(data), 2):
-                if data[i:i+2] == term:
-                    index = i
-                    break
-            #if index == len(data):
-            #    warn("Unterminated string in frame '{0}'".format(frame.frameid), Warning)
-            if index & 1:
-                raise EOFError()
-            rawstr = data[:index]
-            data = data[index+2:]
-        return rawstr.decode(enc), data
+        value, offset = EncodedStringSpec.read_at(self, frame, data, 0)
+        return value, data[offset:]
+
+    def read_at(self, frame, data, offset):
+        return self._readers[frame.encoding](data, offset)
 
     def write(self, frame, value):
-        assert frame.encoding is not None
-        enc, term = self._encodings[frame.encoding]
-        return value.encode(enc) + term
+        return self._writers[frame.encoding](value)
 
     def validate(self, frame, value):
         if value is None:
             return ""
         if not isinstance(value, str):
             raise TypeError("Not a string")
-        if frame.encoding is not None:
+        # ASCII text is valid in every ID3 encoding.
+        if frame.encoding is not None and not _isascii(value):
             self.write(frame, value)
         return value
 
 class EncodedFullTextSpec(EncodedStringSpec):
-    pass # TODO
+    __slots__ = () # TODO
 
 class SequenceSpec(Spec):
     """Recognizes a sequence of values, all of the same spec."""
+    __slots__ = ("spec",)
     def __init__(self, name, spec):
         super().__init__(name)
         self.spec = spec
 
     def read(self, frame, data):
         "Returns a list of values, eats all of data."
+        seq, offset = SequenceSpec.read_at(self, frame, data, 0)
+        return seq, data[offset:]
+
+    def read_at(self, frame, data, offset):
         seq = []
-        while data:
-            elem, data = self.spec.read(frame, data)
-            seq.append(elem)
-        return seq, data
+        append = seq.append
+        read_at = self.spec.read_at
+        size = len(data)
+        while offset < size:
+            elem, offset = read_at(frame, data, offset)
+            append(elem)
+        return seq, offset
 
     def write(self, frame, values):
         if isinstance(values, str):
             return self.spec.write(frame, values)
-        data = bytearray()
-        for v in values:
-            data.extend(self.spec.write(frame, v))
-        return data
+        write = self.spec.write
+        return b"".join([write(frame, v) for v in values])
 
     def validate(self, frame, values):
         if values is None:
@@ -388,42 +581,68 @@ class SequenceSpec(Spec):
         return [self.spec.validate(frame, v) for v in values]
 
 class MultiSpec(Spec):
+    __slots__ = ("specs", "_packer")
     def __init__(self, name, *specs):
         super().__init__(name)
         self.specs = specs
+        # Records made only of plain integers are read and written
+        # with a single struct.
+        if all(type(s) in (ByteSpec, IntegerSpec, SignedIntegerSpec)
+               and s._struct_format is not None for s in specs):
+            self._packer = struct.Struct(
+                ">" + "".join(s._struct_format for s in specs))
+        else:
+            self._packer = None
 
     def read(self, frame, data):
+        seq, offset = MultiSpec.read_at(self, frame, data, 0)
+        return seq, data[offset:]
+
+    def read_at(self, frame, data, offset):
         seq = []
-        while data:
+        size = len(data)
+        packer = self._packer
+        if packer is not None and offset < size:
+            end = offset + (size - offset) // packer.size * packer.size
+            seq.extend(packer.iter_unpack(memoryview(data)[offset:end]))
+            # A partial record at the end is junk, handled below.
+            offset = end
+        readers = [s.read_at for s in self.specs]
+        while offset < size:
             record = []
-            origdata = data
+            origoffset = offset
             try:
-                for s in self.specs:
-                    elem, data = s.read(frame, data)
+                for read_at in readers:
+                    elem, offset = read_at(frame, data, offset)
                     record.append(elem)
                 seq.append(tuple(record))
             except (EOFError, ValueError):
                 if len(seq) == 0:
                     raise
-                warn("Frame {0} has {1} bytes of junk at end".format(frame.frameid, len(origdata)), 
+                junkdata = data[origoffset:]
+                warn("Frame {0} has {1} bytes of junk at end".format(frame.frameid, len(junkdata)), 
                      FrameWarning)
-                frame.junkdata = origdata
-                data = b''
-        return seq, data
+                frame.junkdata = junkdata
+                offset = size
+        return seq, offset
 
     def write(self, frame, values):
-        data = bytearray()
-        for v in values:
-            for i in range(len(self.specs)):
-                data.extend(self.specs[i].write(frame, v[i]))
-        return bytes(data)
+        if self._packer is not None:
+            try:
+                return b"".join([self._packer.pack(*v) for v in values])
+            except struct.error:
+                # Let the specs report unset or out-of-range values.
+                pass
+        specs = tuple(enumerate(self.specs))
+        return b"".join([spec.write(frame, v[i])
+                         for v in values for (i, spec) in specs])
 
     def validate(self, frame, values):
         if values is None:
             return []
         res = []
         for v in values:
-            if not isinstance(v, collections.Sequence) or isinstance(v, str):
+            if not _is_sequence(v):
                 raise TypeError("Records must be sequences")
             if len(v) != len(self.specs):
                 raise ValueError("Invalid record length")
@@ -433,17 +652,28 @@ class MultiSpec(Spec):
 
 class ASPISpec(Spec):
     "A list of frame.N integers whose width depends on frame.b."
+    __slots__ = ()
     def read(self, frame, data):
-        width = 1 if frame.b == 1 else 2
-        value = []
-        if len(data) < width * frame.N:
+        value, offset = ASPISpec.read_at(self, frame, data, 0)
+        return value, data[offset:]
+
+    @staticmethod
+    @functools.lru_cache(maxsize=32)
+    def _struct(b, count):
+        return struct.Struct(">{0}{1}".format(count, "B" if b == 1 else "H"))
+
+    def read_at(self, frame, data, offset):
+        st = ASPISpec._struct(frame.b, frame.N)
+        if len(data) < offset + st.size:
             raise EOFError
-        for i in range(frame.N):
-            value.append(Int8.decode(data[:width]))
-            data = data[width:]
-        return value, data
+        return list(st.unpack_from(data, offset)), offset + st.size
 
     def write(self, frame, values):
+        try:
+            return ASPISpec._struct(frame.b, len(values)).pack(*values)
+        except struct.error:
+            pass
+        # Let Int8 report out-of-range values
         width = 1 if frame.b == 1 else 2
         data = bytearray()
         for v in values:
@@ -453,7 +683,7 @@ class ASPISpec(Spec):
     def validate(self, frame, values):
         if values is None:
             return []
-        if not isinstance(values, collections.Sequence) or isinstance(values, str):
+        if not _is_sequence(values):
             raise TypeError("ASPISpec needs a sequence of integers")
         if len(values) != frame.N:
             raise ValueError("ASPISpec needs {0} integers".format(frame.N))
@@ -464,6 +694,7 @@ class ASPISpec(Spec):
         return res
 
 class PictureTypeSpec(ByteSpec):
+    __slots__ = ()
     picture_types = (
         "Other", "32x32 icon", "Other icon", "Front Cover", "Back Cover",
         "Leaflet", "Media", "Lead artist", "Artist", "Conductor",
@@ -471,19 +702,29 @@ class PictureTypeSpec(ByteSpec):
         "Recording Location", "Recording", "Performance", "Screen capture",
         "A bright coloured fish", "Illustration", "Band/artist",
         "Publisher/Studio")
+    _picture_type_index = {name.lower(): i 
+                           for (i, name) in enumerate(picture_types)}
+
+    def read(self, frame, data):
+        value, data = super().read(frame, data)
+        if value >= len(self.picture_types):
+            raise ValueError("Unknown picture type 0x{0:X}".format(value))
+        return value, data
+
+    def read_at(self, frame, data, offset):
+        value, offset = super().read_at(frame, data, offset)
+        if value >= len(self.picture_types):
+            raise ValueError("Unknown picture type 0x{0:X}".format(value))
+        return value, offset
 
     def validate(self, frame, value):
         if value is None:
             return value
         if isinstance(value, str):
-            def matches(value, name):
-                return value.lower() == name.lower()
-            for i in range(len(self.picture_types)):
-                if matches(value, self.picture_types[i]):
-                    value = i
-                    break
-            else:
-                raise ValueError("Unknown picture type: " + repr(value))
+            try:
+                value = self._picture_type_index[value.lower()]
+            except KeyError:
+                raise ValueError("Unknown picture type: " + repr(value)) from None
         if not isinstance(value, int):
             raise TypeError("Not a picture type")
         if 0 <= value < len(self.picture_types):
@@ -491,5 +732,8 @@ class PictureTypeSpec(ByteSpec):
         raise ValueError("Unknown picture type 0x{0:X}".format(value))
 
     def to_str(self, value):
-        return "{1}({0})".format(value, self.picture_types[value])
+        types = self.picture_types
+        if value is not None and 0 <= value < len(types):
+            return "{1}({0})".format(value, types[value])
+        return "Unknown({0})".format(value)
 
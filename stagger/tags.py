@@ -31,11 +31,11 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 import abc
+import sys
 import struct
 import re
 import collections
 import io
-import imghdr
 import zlib
 
 from abc import abstractmethod, abstractproperty
@@ -76,13 +76,83 @@ _FRAME24_STATUS_DISCARD_ON_FILE_ALTER = 0x2000
 _FRAME24_STATUS_READ_ONLY = 0x1000
 _FRAME24_STATUS_UNKNOWN_MASK = 0x8F00
 
-def read_tag(filename):
+# Allow a single space at end of four-character ids
+# Some programs (e.g. iTunes 8.2) generate such frames when converting
+# from 2.2 to 2.3/2.4 tags.
+_frame_id_pattern = re.compile(b"^[A-Z][A-Z0-9]{2}[A-Z0-9 ]?$")
+# Exact-length variants used when encoding frames
+_frame_id_pattern22 = re.compile(b"[A-Z][A-Z0-9]{2}\\Z")
+_frame_id_pattern23 = re.compile(b"[A-Z][A-Z0-9]{2}[A-Z0-9 ]\\Z")
+
+def _encode_frame_id(frameid, pattern):
+    "Return frameid as ASCII bytes, or None if it doesn't match pattern."
+    try:
+        data = frameid.encode("ASCII")
+    except UnicodeEncodeError:
+        return None
+    return data if pattern.match(data) else None
+
+# ID3v2.3/2.4 frame header: frame id, size, flags
+_frame_header = struct.Struct(">4sIH")
+# ID3v2 tag header: "ID3", version, revision, flags, syncsafe size
+_tag_header = struct.Struct(">3sBBBI")
+# ID3v2.3 extended header: size, flags, padding size
+_ext_header23 = struct.Struct(">IHI")
+_uint32 = struct.Struct(">I")
+
+def _encode_syncsafe32(value):
+    "Encode value as a 32-bit syncsafe integer, to be packed as a plain one."
+    if value < 0:
+        raise ValueError("value is negative")
+    if value >= 1 << 28:
+        raise ValueError("Integer too large")
+    return (((value << 3) & 0x7F000000) | ((value << 2) & 0x7F0000)
+            | ((value << 1) & 0x7F00) | (value & 0x7F))
+
+def _unpack_syncsafe32(data, offset=0):
+    "Decode the 4-byte syncsafe integer at offset in data."
+    return _decode_syncsafe32(_uint32.unpack_from(data, offset)[0])
+
+def _skip_frame_data(file, ufile, size):
+    "Skip over size bytes of frame data read through ufile."
+    if ufile is file:
+        file.seek(size, io.SEEK_CUR)
+    else:
+        # Unsynchronised data can only be skipped by reading it.
+        fileutil.xread(ufile, size)
+
+def _decode_syncsafe32(value):
+    "Decode a 32-bit syncsafe integer that was read as a plain one."
+    if value & 0x80808080:  # iTunes bug
+        raise ValueError("Invalid syncsafe integer")
+    return (((value & 0x7F000000) >> 3) | ((value & 0x7F0000) >> 2)
+            | ((value & 0x7F00) >> 1) | (value & 0x7F))
+
+def read_tag(filename, skip_bozo=False, include=None, exclude=None):
+    """Read the ID3v2 tag in filename.
+
+    If skip_bozo is true, the contents of obscure frame types (those
+    marked as bozo frames) are not decoded; such frames are returned
+    as UnknownFrames holding their raw data.  Like other unknown frames,
+    they are dropped when the tag is written, so this is meant for
+    read-only scans.
+
+    include and exclude are optional collections of frame ids (as they
+    appear in the file, e.g. "APIC" or "PIC"); a single frame id may
+    also be given as a plain string.  When include is given, only
+    those frames are read; frames in exclude are never read.  
+    Skipped frames are not even loaded into memory, which makes scans
+    of files with large embedded pictures much cheaper.  They are also
+    missing from the returned tag, so writing it back loses them.
+    """
     with fileutil.opened(filename, "rb") as file:
         (cls, offset, length) = detect_tag(file)
-        return cls.read(file, offset)
+        return cls.read(file, offset, skip_bozo=skip_bozo,
+                        include=include, exclude=exclude)
 
-def decode_tag(data):
-    return read_tag(io.BytesIO(data))
+def decode_tag(data, skip_bozo=False, include=None, exclude=None):
+    return read_tag(io.BytesIO(data), skip_bozo=skip_bozo,
+                    include=include, exclude=exclude)
 
 def delete_tag(filename):
     with fileutil.opened(filename, "rb+") as file:
@@ -104,18 +174,39 @@ def detect_tag(filename):
         file.seek(0)
         if len(header) < 10:
             raise NoTagError("File too short")
-        if header[0:3] != b"ID3":
+        (magic, version, revision, flags, size) = _tag_header.unpack(header)
+        if magic != b"ID3":
             raise NoTagError("ID3v2 tag not found")
-        if header[3] not in _tag_versions or header[4] != 0:
+        cls = _tag_versions.get(version)
+        if cls is None or revision != 0:
             raise TagError("Unknown ID3 version: 2.{0}.{1}"
-                           .format(*header[3:5]))
-        cls = _tag_versions[header[3]]
+                           .format(version, revision))
         offset = 0
-        length = Syncsafe.decode(header[6:10]) + 10
-        if header[3] == 4 and header[5] & _TAG24_FOOTER:
+        length = _decode_syncsafe32(size) + 10
+        if version == 4 and flags & _TAG24_FOOTER:
             length += 10
         return (cls, offset, length)
 
+def _frame_filter(include, exclude):
+    """Return a predicate that is true for the frame ids that read_tag 
+    should skip, or None if all frames are to be read."""
+    if include is None and exclude is None:
+        return None
+    # A bare string is a single frame id, not a collection of letters.
+    if isinstance(include, str):
+        include = (include,)
+    if isinstance(exclude, str):
+        exclude = (exclude,)
+    if include is not None:
+        include = frozenset(include)
+    exclude = frozenset(exclude or ())
+    def skip(frameid):
+        return (frameid in exclude 
+                or (include is not None and frameid not in include))
+    return skip
+
+_v2_frames = {}   # Maps v2.3/v2.4 frame classes to their v2.2 versions
+
 def frameclass(cls):
     """Register cls as a class representing an ID3 frame.
 
@@ -134,7 +225,13 @@ def frameclass(cls):
     if len(cls.__name__) == 3:
         base = cls.__bases__[0]
         if issubclass(base, Frames.Frame) and base._in_version(3, 4):
-            assert not hasattr(base, "_v2_frame")
+            # Look in our own registry rather than using hasattr, which
+            # would also find _v2_frame attributes inherited by base.
+            if base in _v2_frames:
+                raise TypeError("{0}: {1} already has an ID3v2.2 frame: {2}"
+                                .format(cls.__name__, base.__name__,
+                                        _v2_frames[base].__name__))
+            _v2_frames[base] = cls
             base._v2_frame = cls
             # Override frameid from base with v2.2 name
             if base.frameid == cls.frameid:
@@ -150,10 +247,12 @@ def frameclass(cls):
         cls._version = 2
     if len(cls.frameid) == 4 and not cls._version:
         cls._version = (3, 4)
+    cls._versions = Frames._version_set(cls._version)
 
     # Register cls as a known frame.
     assert cls.frameid not in Tag.known_frames
     Tag.known_frames[cls.frameid] = cls
+    Tag._known_frame_ids[cls.frameid.encode("ASCII")] = sys.intern(cls.frameid)
     
     return cls
 
@@ -179,10 +278,11 @@ class FrameOrder:
     def __init__(self, *patterns):
         self.re_keys = []
         self.frame_keys = dict()
+        self._primary_keys = dict() # Cache of (type, frameid) -> primary key
         i = -1
         for (i, pattern) in zip(range(len(patterns)), patterns):
             if isinstance(pattern, str):
-                self.re_keys.append((pattern, i))
+                self.re_keys.append((re.compile(pattern), i))
             else:
                 assert issubclass(pattern, Frames.Frame)
                 self.frame_keys[pattern] = i
@@ -190,29 +290,33 @@ class FrameOrder:
 
     def key(self, frame):
         "Return the sort key for the given frame."
-        def keytuple(primary):
-            if frame.frameno is None:
-                return (primary, 1)
-            return (primary, 0, frame.frameno)
-
+        cachekey = (type(frame), frame.frameid)
+        primary = self._primary_keys.get(cachekey)
+        if primary is None:
+            primary = self._primary_keys[cachekey] = self._primary_key(frame)
+        if frame.frameno is None:
+            return (primary, 1)
+        return (primary, 0, frame.frameno)
+
+    def _primary_key(self, frame):
         # Look up frame by exact match
         if type(frame) in self.frame_keys:
-            return keytuple(self.frame_keys[type(frame)])
+            return self.frame_keys[type(frame)]
 
         # Look up parent frame for v2.2 frames
         if frame._in_version(2) and type(frame).__bases__[0] in self.frame_keys:
-            return keytuple(self.frame_keys[type(frame).__bases__[0]])
+            return self.frame_keys[type(frame).__bases__[0]]
 
         # Try each pattern
         for (pattern, key) in self.re_keys:
-            if re.match(pattern, frame.frameid):
-                return keytuple(key)
+            if pattern.match(frame.frameid):
+                return key
 
-        return keytuple(self.unknown_key)
+        return self.unknown_key
 
     def __repr__(self):
         order = []
-        order.extend((repr(pair[0]), pair[1]) for pair in self.re_keys)
+        order.extend((repr(pair[0].pattern), pair[1]) for pair in self.re_keys)
         order.extend((cls.__name__, self.frame_keys[cls]) 
                      for cls in self.frame_keys)
         order.sort(key=lambda pair: pair[1])
@@ -221,6 +325,7 @@ class FrameOrder:
 
 class Tag(collections.MutableMapping, metaclass=abc.ABCMeta):
     known_frames = { }        # Maps known frameids to Frame class objects
+    _known_frame_ids = { }    # Maps encoded known frameids to interned strs
 
     frame_order = None        # Initialized by stagger.id3
 
@@ -282,23 +387,22 @@ class Tag(collections.MutableMapping, metaclass=abc.ABCMeta):
         """
         if Frames.is_frame_class(key):
             key = key.frameid
-        if isinstance(key, str):
+        if isinstance(key, str) and key not in self.known_frames:
+            # Registered frame ids are known to be valid.
             if not self._is_frame_id(key):
                 raise KeyError("{0}: Invalid frame id".format(key))
-            if key not in self.known_frames:
-                if unknown_ok:
-                    warn("{0}: Unknown frame id".format(key), UnknownFrameWarning)
-                else:
-                    raise KeyError("{0}: Unknown frame id".format(key))
+            if unknown_ok:
+                warn("{0}: Unknown frame id".format(key), UnknownFrameWarning)
+            else:
+                raise KeyError("{0}: Unknown frame id".format(key))
         return key
 
     # Mapping accessor (with extra magic, for convenience)
     def __getitem__(self, key):
         key = self._normalize_key(key)
         fs = self.frames(key)
-        allow_duplicates = (key not in self.known_frames 
-                            or self.known_frames[key]._allow_duplicates)
-        if allow_duplicates:
+        frametype = self.known_frames.get(key)
+        if frametype is None or frametype._allow_duplicates:
             return fs
         if len(fs) > 1:
             # Merge duplicates into one ephemeral frame, and return that.
@@ -312,17 +416,18 @@ class Tag(collections.MutableMapping, metaclass=abc.ABCMeta):
 
     def __setitem__(self, key, value):
         key = self._normalize_key(key, unknown_ok=False)
-        if isinstance(value, self.known_frames[key]):
+        frametype = self.known_frames[key]
+        if isinstance(value, frametype):
             self._frames[key] = [value]
             return
-        if self.known_frames[key]._allow_duplicates:
+        if frametype._allow_duplicates:
             if not isinstance(value, collections.Iterable) or isinstance(value, str):
                 raise ValueError("{0} requires a list of frame values".format(key))
-            self._frames[key] = [val if isinstance(val, self.known_frames[key])
-                                 else self.known_frames[key](val) 
+            self._frames[key] = [val if isinstance(val, frametype)
+                                 else frametype(val) 
                                  for val in value]
         else: # not _allow_duplicates
-            self._frames[key] = [self.known_frames[key](value)]
+            self._frames[key] = [frametype(value)]
 
     def __delitem__(self, key):
         del self._frames[self._normalize_key(key)]
@@ -512,6 +617,7 @@ class Tag(collections.MutableMapping, metaclass=abc.ABCMeta):
             if frameid not in self:
                 return ""
             else:
+                import imghdr
                 return ", ".join("{0}:{1}:<{2} bytes of {3} data>"
                                  .format(f._spec("type").to_str(f.type),
                                          f.desc,
@@ -572,24 +678,26 @@ class Tag(collections.MutableMapping, metaclass=abc.ABCMeta):
 
     # Reading tags
     @classmethod
-    def read(cls, filename, offset=0):
-        """Read an ID3v2 tag from a file."""
+    def read(cls, filename, offset=0, skip_bozo=False, 
+             include=None, exclude=None):
+        """Read an ID3v2 tag from a file.  
+        See read_tag for skip_bozo, include and exclude."""
         i = 0
+        skip = _frame_filter(include, exclude)
         with fileutil.opened(filename, "rb") as file:
             file.seek(offset)
             tag = cls()
             tag._read_header(file)
-            for (frameid, bflags, data) in tag._read_frames(file):
+            for (frameid, bflags, data) in tag._read_frames(file, skip=skip):
                 if len(data) == 0:
                     warn("{0}: Ignoring empty frame".format(frameid), 
                          EmptyFrameWarning)
                 else:
-                    frame = tag._decode_frame(frameid, bflags, data, i)
+                    frame = tag._decode_frame(frameid, bflags, data, i,
+                                              skip_bozo=skip_bozo)
                     if frame is not None:
                         l = tag._frames.setdefault(frame.frameid, [])
                         l.append(frame)
-                        if file.tell() > tag.offset + tag.size:
-                            break
                         i += 1
             try:
                 tag._filename = file.name
@@ -598,18 +706,24 @@ class Tag(collections.MutableMapping, metaclass=abc.ABCMeta):
             return tag
 
     @classmethod
-    def decode(cls, data):
-        return cls.read(io.BytesIO(data))
+    def decode(cls, data, skip_bozo=False, include=None, exclude=None):
+        return cls.read(io.BytesIO(data), skip_bozo=skip_bozo,
+                        include=include, exclude=exclude)
 
-    def _decode_frame(self, frameid, bflags, data, frameno=None):
+    def _decode_frame(self, frameid, bflags, data, frameno=None, 
+                      skip_bozo=False):
         try:
             (flags, data) = self._interpret_frame_flags(frameid, bflags, data)
             if flags is None: 
                 flags = set()
-            if frameid in self.known_frames:
-                return self.known_frames[frameid]._decode(frameid, data, 
-                                                          flags, 
-                                                          frameno=frameno)
+            frametype = self.known_frames.get(frameid)
+            if frametype is not None:
+                if skip_bozo and frametype._bozo:
+                    # Keep the raw frame data without parsing it.
+                    return Frames.UnknownFrame(frameid=frameid, flags=flags,
+                                               frameno=frameno, data=data)
+                return frametype._decode(frameid, data, flags, 
+                                          frameno=frameno)
             else:
                 # Unknown frame
                 flags.add("unknown")
@@ -631,7 +745,7 @@ class Tag(collections.MutableMapping, metaclass=abc.ABCMeta):
     def _read_header(self, file): pass
 
     @abstractmethod
-    def _read_frames(self, file): pass
+    def _read_frames(self, file, skip=None): pass
 
     @abstractmethod
     def _interpret_frame_flags(self, frameid, bflags, data): pass
@@ -678,23 +792,26 @@ class Tag(collections.MutableMapping, metaclass=abc.ABCMeta):
             try:
                 data = data.encode("ASCII")
             except UnicodeEncodeError:
-                return false
-        # Allow a single space at end of four-character ids
-        # Some programs (e.g. iTunes 8.2) generate such frames when converting
-        # from 2.2 to 2.3/2.4 tags.
-        pattern = re.compile(b"^[A-Z][A-Z0-9]{2}[A-Z0-9 ]?$")
-        return pattern.match(data)
+                return False
+        return _frame_id_pattern.match(data)
+
+    @classmethod
+    def _decode_frame_id(cls, data):
+        """Return the frame id in data as an interned string, or None if 
+        data isn't a valid frame id."""
+        frameid = cls._known_frame_ids.get(data)
+        if frameid is None and cls._is_frame_id(data):
+            frameid = sys.intern(data.decode("ASCII"))
+        return frameid
 
     def _prepare_frames_hook(self):
         pass
 
     def _prepare_frames(self):
-        # Generate dictionary of frames
         d = self._frames
 
         # Merge duplicate frames
-        for frameid in self._frames.keys():
-            fs = self._frames[frameid]
+        for frameid, fs in d.items():
             if len(fs) > 1:
                 d[frameid] = fs[0]._merge(fs)
 
@@ -702,8 +819,8 @@ class Tag(collections.MutableMapping, metaclass=abc.ABCMeta):
 
         # Convert frames
         newframes = []
-        for frameid in self._frames.keys():
-            for frame in self._frames[frameid]:
+        for frameid, fs in d.items():
+            for frame in fs:
                 try:
                     newframes.append(frame._to_version(self.version))
                 except IncompatibleFrameError:
@@ -777,39 +894,49 @@ class Tag22(Tag):
             raise TagError("ID3v2.2 tag compression is not supported")
         if header[5] & 0x3F:
             warn("Unknown ID3v2.2 flags", TagWarning)
-        self.size = Syncsafe.decode(header[6:10]) + 10
+        self.size = _unpack_syncsafe32(header, 6) + 10
 
-    def _read_frames(self, file):
+    def _read_frames(self, file, skip=None):
         if "unsynchronised" in self.flags:
             ufile = UnsyncReader(file)
         else:
             ufile = file
-        while file.tell() < self.offset + self.size:
+        # Track the position ourselves unless unsynchronisation makes
+        # the number of bytes consumed from file unpredictable.
+        pos = file.tell()
+        end = self.offset + self.size
+        while pos < end:
             header = fileutil.xread(ufile, 6)
-            if not self._is_frame_id(header[0:3]):
+            frameid = self._decode_frame_id(header[0:3])
+            if frameid is None:
                 break
-            frameid = header[0:3].decode("ASCII")
-            size = Int8.decode(header[3:6])
-            data = fileutil.xread(ufile, size)
-            yield (frameid, None, data)
+            size = (header[3] << 16) | (header[4] << 8) | header[5]
+            if skip is not None and skip(frameid):
+                _skip_frame_data(file, ufile, size)
+            else:
+                data = fileutil.xread(ufile, size)
+                yield (frameid, None, data)
+            if ufile is file:
+                pos += 6 + size
+            else:
+                pos = file.tell()
 
     def _interpret_frame_flags(self, frameid, bflags, data):
         # No frame flags in v2.2
         return (None, data)
 
-    def __encode_one_frame(self, frame):
+    def __write_one_frame(self, out, frame):
+        "Append the encoded frame to the bytearray out."
         framedata = frame._encode(encodings=self.encodings)
 
-        data = bytearray()
         # Frame id
-        if len(frame.frameid) != 3 or not self._is_frame_id(frame.frameid):
-            raise "Invalid ID3v2.2 frame id {0}".format(repr(frame.frameid))
-        data.extend(frame.frameid.encode("ASCII"))
+        frameid = _encode_frame_id(frame.frameid, _frame_id_pattern22)
+        if frameid is None:
+            raise ValueError("Invalid ID3v2.2 frame id {0}".format(repr(frame.frameid)))
+        out += frameid
         # Size
-        data.extend(Int8.encode(len(framedata), width=3))
-        assert(len(data) == 6)
-        data.extend(framedata)
-        return data
+        out += Int8.encode(len(framedata), width=3)
+        out += framedata
 
     def _prepare_frames_hook(self):
         for frameid in self._frames.keys():
@@ -825,21 +952,21 @@ class Tag22(Tag):
         if len(self) == 0:  # No frames -> no tag
             return b""
         frames = self._prepare_frames()
-        framedata = bytearray().join(self.__encode_one_frame(frame)
-                                     for frame in frames)
+        # Encode frames straight into the tag buffer after a placeholder
+        # for the header.
+        data = bytearray(10)
+        for frame in frames:
+            self.__write_one_frame(data, frame)
         if "unsynchronised" in self.flags:
-            framedata = Unsync.encode(framedata)
+            data[10:] = Unsync.encode(data[10:])
 
-        size = self._get_size_with_padding(size_hint, len(framedata) + 10)
+        size = self._get_size_with_padding(size_hint, len(data))
 
-        data = bytearray()
-        data.extend(b"ID3\x02\x00")
-        data.append(0x80 if "unsynchronised" in self.flags else 0x00)
-        data.extend(Syncsafe.encode(size - 10, width=4))
-        assert len(data) == 10
-        data.extend(framedata)
+        flagval = 0x80 if "unsynchronised" in self.flags else 0x00
+        _tag_header.pack_into(data, 0, b"ID3", 2, 0, flagval,
+                              _encode_syncsafe32(size - 10))
         if size > len(data):
-            data.extend(b"\x00" * (size - len(data)))
+            data.extend(bytes(size - len(data)))
         assert len(data) == size
         return data
 
@@ -903,13 +1030,13 @@ class Tag23(Tag):
             self.flags.add("experimental")
         if header[5] & 0x1F:
             warn("Unknown ID3v2.3 flags", TagWarning)
-        self.size = Syncsafe.decode(header[6:10]) + 10
+        self.size = _unpack_syncsafe32(header, 6) + 10
         if "extended_header" in self.flags:
             self.__read_extended_header(file)
 
     def __read_extended_header(self, file):
         (size, ext_flags, self.padding_size) = \
-            struct.unpack("!IHI", fileutil.xread(file, 10))
+            _ext_header23.unpack(fileutil.xread(file, 10))
         if size != 6 and size != 10:
             warn("Unexpected size of ID3v2.3 extended header: {0}".format(size), 
                  TagWarning)
@@ -919,35 +1046,48 @@ class Tag23(Tag):
                      TagWarning)
             else:
                 self.flags.add("ext:crc_present")
-                (self.crc32,) = struct.unpack("!I", fileutil.xread(file, 4))
+                (self.crc32,) = _uint32.unpack(fileutil.xread(file, 4))
                 size -= 6
         if size > 6:
             fileutil.xread(file, size - 6)
 
-    def _read_frames(self, file):
+    def _read_frames(self, file, skip=None):
         if "unsynchronised" in self.flags:
             ufile = UnsyncReader(file)
         else:
             ufile = file
-        while file.tell() < self.offset + self.size:
+        # Track the position ourselves unless unsynchronisation makes
+        # the number of bytes consumed from file unpredictable.
+        pos = file.tell()
+        end = self.offset + self.size
+        while pos < end:
             header = fileutil.xread(ufile, 10)
-            if not self._is_frame_id(header[0:4]):
+            (rawid, size, bflags) = _frame_header.unpack(header)
+            frameid = self._decode_frame_id(rawid)
+            if frameid is None:
                 break
-            frameid = header[0:4].decode("ASCII")
-            size = Int8.decode(header[4:8])
-            bflags = Int8.decode(header[8:10])
-            data = fileutil.xread(ufile, size)
-            yield (frameid, bflags, data)
+            if skip is not None and skip(frameid):
+                _skip_frame_data(file, ufile, size)
+            else:
+                data = fileutil.xread(ufile, size)
+                yield (frameid, bflags, data)
+            if ufile is file:
+                pos += 10 + size
+            else:
+                pos = file.tell()
 
     def _interpret_frame_flags(self, frameid, bflags, data):
         flags = set()
+        if not bflags:
+            # The common case: none of the tests below would fire.
+            return flags, data
         # Frame encoding flags
         if bflags & _FRAME23_FORMAT_UNKNOWN_MASK:
             raise FrameError("{0}: Invalid ID3v2.3 frame encoding flags: 0x{0:X}".format(frameid, bflags))
         if bflags & _FRAME23_FORMAT_COMPRESSED:
             flags.add("compressed")
             expanded_size = Int8.decode(data[0:4])
-            data = zlib.decompress(data[4:])
+            data = zlib.decompress(memoryview(data)[4:])
         if bflags & _FRAME23_FORMAT_ENCRYPTED:
             raise FrameError("{0}: Can't read ID3v2.3 encrypted frames".format(frameid))
         if bflags & _FRAME23_FORMAT_GROUP:
@@ -966,7 +1106,8 @@ class Tag23(Tag):
                  TagWarning)
         return flags, data
 
-    def __encode_one_frame(self, frame):
+    def __write_one_frame(self, out, frame):
+        "Append the encoded frame to the bytearray out."
         framedata = frame._encode(encodings=self.encodings)
         origlen = len(framedata)
 
@@ -990,44 +1131,40 @@ class Tag23(Tag):
         if "read_only" in frame.flags:
             flagval |= _FRAME23_STATUS_READ_ONLY
 
-        data = bytearray()
         # Frame id
-        if len(frame.frameid) != 4 or not self._is_frame_id(frame.frameid.encode("ASCII")):
+        frameid = _encode_frame_id(frame.frameid, _frame_id_pattern23)
+        if frameid is None:
             raise ValueError("Invalid ID3v2.3 frame id {0}".format(repr(frame.frameid)))
-        data.extend(frame.frameid.encode("ASCII"))
-        # Size
-        data.extend(Int8.encode(len(frameinfo) + len(framedata), width=4))
-        # Flags
-        data.extend(Int8.encode(flagval, width=2))
-        assert len(data) == 10
+        size = len(frameinfo) + len(framedata)
+        if size >= 1 << 32:
+            raise ValueError("Frame too large")
+        out += _frame_header.pack(frameid, size, flagval)
         # Format info
-        data.extend(frameinfo)
+        out += frameinfo
         # Frame data
-        data.extend(framedata)
-        return data
+        out += framedata
 
     def encode(self, size_hint=None):
         if len(self) == 0:  # No frames -> no tag
             return b""
         frames = self._prepare_frames()
-        framedata = bytearray().join(self.__encode_one_frame(frame)
-                                     for frame in frames)
+        # Encode frames straight into the tag buffer after a placeholder
+        # for the header.
+        data = bytearray(10)
+        for frame in frames:
+            self.__write_one_frame(data, frame)
         if "unsynchronised" in self.flags:
-            framedata = Unsync.encode(framedata)
+            data[10:] = Unsync.encode(data[10:])
 
-        size = self._get_size_with_padding(size_hint, len(framedata) + 10)
+        size = self._get_size_with_padding(size_hint, len(data))
 
-        data = bytearray()
-        data.extend(b"ID3\x03\x00")
         flagval = 0x00
         if "unsynchronised" in self.flags:
             flagval |= 0x80
-        data.append(flagval)
-        data.extend(Syncsafe.encode(size - 10, width=4))
-        assert len(data) == 10
-        data.extend(framedata)
+        _tag_header.pack_into(data, 0, b"ID3", 3, 0, flagval,
+                              _encode_syncsafe32(size - 10))
         if size > len(data):
-            data.extend(b"\x00" * (size - len(data)))
+            data.extend(bytes(size - len(data)))
         assert len(data) == size
         return data
 
@@ -1095,7 +1232,7 @@ class Tag24(Tag):
             self.flags.add("footer")
         if header[5] & _TAG24_UNKNOWN_MASK:
             warn("Unknown ID3v2.4 flags", TagWarning)
-        self.size = (Syncsafe.decode(header[6:10]) + 10 
+        self.size = (_unpack_syncsafe32(header, 6) + 10 
                      + (10 if "footer" in self.flags else 0))
         if "extended_header" in self.flags:
             self.__read_extended_header(file)
@@ -1108,7 +1245,7 @@ class Tag24(Tag):
         return (data[1:1+length], data[1+length:])
 
     def __read_extended_header(self, file):
-        size = Syncsafe.decode(fileutil.xread(file, 4))
+        size = _unpack_syncsafe32(fileutil.xread(file, 4))
         if size < 6:
             warn("Unexpected size of ID3v2.4 extended header: {0}".format(size), 
                  TagWarning)
@@ -1132,7 +1269,7 @@ class Tag24(Tag):
             self.flags.add("ext:restrictions")
             (self.restrictions, data) = self.__read_extended_header_flag_data(data)
 
-    def _read_frames(self, file, syncsafe_workaround = None):
+    def _read_frames(self, file, syncsafe_workaround = None, skip=None):
         # Older versions of iTunes stored frame sizes as straight 8bit integers,
         # not syncsafe values as the spec requires.
         # (The bug is known to be fixed in iTunes 8.2.)
@@ -1153,48 +1290,58 @@ class Tag24(Tag):
         if syncsafe_workaround is None:
             syncsafe_workaround = self.ITUNES_WORKAROUND
         origfpos = file.tell()
+        pos = origfpos
+        end = self.offset + self.size
         frames = []
-        while file.tell() < self.offset + self.size:
+        while pos < end:
             header = fileutil.xread(file, 10)
-            if not self._is_frame_id(header[0:4]):
+            (rawid, size, bflags) = _frame_header.unpack(header)
+            frameid = self._decode_frame_id(rawid)
+            if frameid is None:
                 break
-            frameid = header[0:4].decode("ASCII")
-            if syncsafe_workaround:
-                size = Int8.decode(header[4:8])
-            else:
+            if not syncsafe_workaround:
                 try:
-                    size = Syncsafe.decode(header[4:8])
+                    size = _decode_syncsafe32(size)
                 except ValueError:
                     if syncsafe_workaround:
                         raise
                     warn("Invalid syncsafe frame size; switching to 8-bit mode")
                     file.seek(origfpos)
-                    return self._read_frames(file, True)
-            bflags = Int8.decode(header[8:10])
-            data = fileutil.xread(file, size)
-            frames.append((frameid, bflags, data))
+                    return self._read_frames(file, True, skip=skip)
+            if skip is not None and skip(frameid):
+                file.seek(size, io.SEEK_CUR)
+            else:
+                frames.append((frameid, bflags, fileutil.xread(file, size)))
+            pos += 10 + size
         return frames
 
     def _interpret_frame_flags(self, frameid, bflags, data):
         flags = set()
+        if not bflags and not self.flags:
+            # The common case: none of the tests below would fire.
+            return flags, data
         # Frame format flags
         if bflags & _FRAME24_FORMAT_UNKNOWN_MASK:
             raise FrameError("{0}: Unknown frame encoding flags: 0x{1:X}".format(frameid, bflags))
+        # Offset of the frame data past any extra header bytes
+        start = 0
         if bflags & _FRAME24_FORMAT_GROUP:
             flags.add("group")
             flags.add("group={0}".format(data[0])) # hack
-            data = data[1:]
+            start = 1
         if bflags & _FRAME24_FORMAT_COMPRESSED:
             flags.add("compressed")
         if bflags & _FRAME24_FORMAT_ENCRYPTED:
             raise FrameError("{0}: Can't read encrypted frames".format(frameid))
         if bflags & _FRAME24_FORMAT_UNSYNCHRONISED:
             flags.add("unsynchronised")
-        expanded_size = len(data)
+        expanded_size = len(data) - start
         if bflags & _FRAME24_FORMAT_DATA_LENGTH_INDICATOR:
             flags.add("data_length_indicator")
-            expanded_size = Syncsafe.decode(data[0:4])
-            data = data[4:]
+            expanded_size = Syncsafe.decode(data[start:start + 4])
+            start += 4
+        if start:
+            data = data[start:]
         if "unsynchronised" in self.flags:
             data = Unsync.decode(data)
         if "compressed" in self.flags:
@@ -1211,7 +1358,8 @@ class Tag24(Tag):
                  .format(frameid, bflags), FrameWarning)
         return flags, data
 
-    def __encode_one_frame(self, frame):
+    def __write_one_frame(self, out, frame):
+        "Append the encoded frame to the bytearray out."
         framedata = frame._encode(encodings=self.encodings)
         origlen = len(framedata)
 
@@ -1233,7 +1381,7 @@ class Tag24(Tag):
             framedata = Unsync.encode(framedata)
             flagval |= _FRAME24_FORMAT_UNSYNCHRONISED
         if "data_length_indicator" in frame.flags:
-            frameinfo.extend(Syncsafe.encode(origlen, width=4))
+            frameinfo.extend(_uint32.pack(_encode_syncsafe32(origlen)))
             flagval |= _FRAME24_FORMAT_DATA_LENGTH_INDICATOR
 
         if "discard_on_tag_alter" in frame.flags:
@@ -1243,21 +1391,16 @@ class Tag24(Tag):
         if "read_only" in frame.flags:
             flagval |= _FRAME24_STATUS_READ_ONLY
 
-        data = bytearray()
         # Frame id
-        if len(frame.frameid) != 4 or not self._is_frame_id(frame.frameid):
-            raise "{0}: Invalid frame id".format(repr(frame.frameid))
-        data.extend(frame.frameid.encode("ASCII"))
-        # Size
-        data.extend(Syncsafe.encode(len(frameinfo) + len(framedata), width=4))
-        # Flags
-        data.extend(Int8.encode(flagval, width=2))
-        assert len(data) == 10
+        frameid = _encode_frame_id(frame.frameid, _frame_id_pattern23)
+        if frameid is None:
+            raise ValueError("Invalid ID3v2.4 frame id {0}".format(repr(frame.frameid)))
+        size = _encode_syncsafe32(len(frameinfo) + len(framedata))
+        out += _frame_header.pack(frameid, size, flagval)
         # Format info
-        data.extend(frameinfo)
+        out += frameinfo
         # Frame data
-        data.extend(framedata)
-        return data
+        out += framedata
 
     def encode(self, size_hint=None):
         if len(self) == 0:  # No frames -> no tag
@@ -1266,22 +1409,21 @@ class Tag24(Tag):
         if "unsynchronised" in self.flags:
             for frame in frames: 
                 frame.flags.add("unsynchronised")
-        framedata = bytearray().join(self.__encode_one_frame(frame)
-                                     for frame in frames)
+        # Encode frames straight into the tag buffer after a placeholder
+        # for the header.
+        data = bytearray(10)
+        for frame in frames:
+            self.__write_one_frame(data, frame)
 
-        size = self._get_size_with_padding(size_hint, len(framedata) + 10)
+        size = self._get_size_with_padding(size_hint, len(data))
 
-        data = bytearray()
-        data.extend(b"ID3\x04\x00")
         flagval = 0x00
         if "unsynchronised" in self.flags:
             flagval |= 0x80
-        data.append(flagval)
-        data.extend(Syncsafe.encode(size - 10, width=4))
-        assert len(data) == 10
-        data.extend(framedata)
+        _tag_header.pack_into(data, 0, b"ID3", 4, 0, flagval,
+                              _encode_syncsafe32(size - 10))
         if size > len(data):
-            data.extend(b"\x00" * (size - len(data)))
+            data.extend(bytes(size - len(data)))
         assert len(data) == size
         return data
 
@@ -66,6 +66,9 @@ class ConversionTestCase(unittest.TestCase):
             e = Unsync.encode(r)
             self.assertFalse(contains_sync(e))
             self.assertTrue(Unsync.decode(e) == r)
+            # Agrees with the byte-at-a-time generators
+            self.assertEqual(e, bytes(Unsync.gen_encode(r)))
+            self.assertEqual(Unsync.decode(r), bytes(Unsync.gen_decode(r)))
 
     def testUnsyncReader(self): 
         for i in range(20):
@@ -74,6 +77,24 @@ class ConversionTestCase(unittest.TestCase):
             file = UnsyncReader(io.BytesIO(e))
             self.assertTrue(file.read(len(r)) == r)
 
+        # Reads of any size stop right after the last byte returned,
+        # like a byte-at-a-time decoder would.
+        for i in range(20):
+            r = bytes(self.random_data(100))
+            e = Unsync.encode(r)
+            # Offsets in e just past each byte of r
+            ends = [i + 1 for (i, b) in enumerate(e)
+                    if not (i > 0 and e[i - 1] == 0xFF and b == 0x00)]
+            raw = io.BytesIO(e)
+            file = UnsyncReader(raw)
+            pos = 0
+            while pos < len(r):
+                n = min(random.randint(1, 10), len(r) - pos)
+                self.assertEqual(file.read(n), r[pos:pos + n])
+                pos += n
+                self.assertEqual(raw.tell(), ends[pos - 1])
+            self.assertRaises(EOFError, file.read, 1)
+
     def testSyncsafe(self):
         self.assertEqual(Syncsafe.encode(1, width=1), b"\x01")
         self.assertEqual(Syncsafe.encode(127, width=1), b"\x7F")
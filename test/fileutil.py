@@ -38,6 +38,8 @@ import tempfile
 import warnings
 import os
 import signal
+import mmap
+import threading
 
 from stagger.fileutil import *
 
@@ -62,6 +64,36 @@ class FileutilTestCase(unittest.TestCase):
             return
         self.assertEqual(foo, 3, "Can't suppress interrupts")
 
+    def testNestedSuppressInterrupt(self):
+        foo = 0
+        try:
+            with suppress_interrupt():
+                with suppress_interrupt():
+                    os.kill(0, signal.SIGINT)  # Simulate C-c
+                    foo += 1
+                # The interrupt must not escape from the inner context.
+                foo += 1
+        except KeyboardInterrupt:
+            foo += 1
+        except (AttributeError, WindowsError):
+            # No os.kill on Windows.
+            return
+        self.assertEqual(foo, 3, "Interrupt raised in inner context")
+
+    def testSuppressInterruptInThread(self):
+        # signal.signal can't be called outside the main thread.
+        errors = []
+        def run():
+            try:
+                with suppress_interrupt():
+                    pass
+            except Exception as e:
+                errors.append(e)
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+        self.assertEqual(errors, [])
+
     def testReplaceChunk(self):
         def compare(data, filename):
             with opened(filename, "rb") as file:
@@ -119,7 +151,32 @@ class FileutilTestCase(unittest.TestCase):
                     self.assertTrue(size == len(data))
             finally:
                 os.unlink(filename)
+
+    def testReplaceChunkWithoutMmap(self):
+        # Exercise the fallback code path in _replace_chunk_in_place.
+        def broken_mmap(*args, **kwargs):
+            raise EnvironmentError("mmap disabled")
+        orig_mmap = mmap.mmap
+        mmap.mmap = broken_mmap
+        try:
+            self.testReplaceChunk()
+        finally:
+            mmap.mmap = orig_mmap
         
+    def testOpenedBuffersRawFiles(self):
+        with tempfile.TemporaryFile() as tmp:
+            tmp.write(bytes(range(100)))
+            tmp.flush()
+            raw = io.FileIO(tmp.fileno(), "rb", closefd=False)
+            raw.seek(10)
+            with opened(raw, "rb") as file:
+                self.assertIsInstance(file, io.BufferedReader)
+                self.assertEqual(file.read(5), bytes(range(10, 15)))
+            # The raw file is left open, right after the data read.
+            self.assertFalse(raw.closed)
+            self.assertEqual(raw.tell(), 15)
+            raw.close()
+
 suite = unittest.TestLoader().loadTestsFromTestCase(FileutilTestCase)
 
 if __name__ == "__main__":
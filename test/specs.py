@@ -31,6 +31,7 @@
 # ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
+import collections
 import unittest
 import warnings
 
@@ -239,6 +240,9 @@ class SpecTestCase(unittest.TestCase):
         self.assertEqual(spec.write(frame, 1), b"\x20\x00\x00\x00\x01")
         self.assertEqual(spec.write(frame, 258), b"\x20\x00\x00\x01\x02")
         self.assertEqual(spec.write(frame, 1 << 32), b"\x40\x00\x00\x00\x01\x00\x00\x00\x00")
+        self.assertEqual(spec.write(frame, (1 << 32) - 1), b"\x20\xFF\xFF\xFF\xFF")
+        self.assertEqual(spec.write(frame, 1 << 64), b"\x60\x00\x00\x00\x01" + bytes(8))
+        self.assertRaises(ValueError, spec.write, frame, -1)
 
         # spec.validate
         self.assertEqual(spec.validate(frame, 5), 5)
@@ -454,10 +458,31 @@ class SpecTestCase(unittest.TestCase):
         # spec.validate
         self.assertEqual(spec.validate(frame, []), [])
         self.assertEqual(spec.validate(frame, [["Foo", 1]] * 10), [("Foo", 1)] * 10)
+        # Any non-string sequence is accepted as a record
+        self.assertEqual(spec.validate(frame, [collections.UserList(["Foo", 1])]),
+                         [("Foo", 1)])
+        self.assertRaises(TypeError, spec.validate, frame, ["ab"])
         self.assertRaises(TypeError, spec.validate, frame, 1)
         self.assertRaises(TypeError, spec.validate, frame, "foo")
         self.assertRaises(ValueError, spec.validate, frame, [["Foo", 2, 2]])
-        
+
+        # Records of plain integers go through a single struct
+        spec = MultiSpec("test", ByteSpec("type"), IntegerSpec("value", 32))
+        self.assertEqual(spec.read(frame, b""), ([], b""))
+        self.assertRaises(EOFError, spec.read, frame, b"\x01\x00")
+        self.assertEqual(spec.read(frame, b"\x01\x00\x00\x01\x02\x02\x00\x00\x00\x03"),
+                         ([(1, 258), (2, 3)], b""))
+        self.assertEqual(spec.read_at(frame, b"XX\x01\x00\x00\x01\x02", 2),
+                         ([(1, 258)], 7))
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", FrameWarning)
+            self.assertEqual(spec.read(frame, b"\x01\x00\x00\x01\x02\x02\x00"),
+                             ([(1, 258)], b""))
+        self.assertEqual(frame.junkdata, b"\x02\x00")
+        self.assertEqual(spec.write(frame, [(1, 258), (2, 3)]),
+                         b"\x01\x00\x00\x01\x02\x02\x00\x00\x00\x03")
+        self.assertRaises(ValueError, spec.write, frame, [(256, 1)])
+
     def testASPISpec(self):
         frame = TextFrame(frameid="TEST", encoding=3)
         spec = ASPISpec("test")
@@ -486,6 +511,7 @@ class SpecTestCase(unittest.TestCase):
         self.assertRaises(ValueError, spec.validate, frame, [])
         self.assertEqual(spec.validate(frame, [1, 2, 3, 4]), [1, 2, 3, 4])
         self.assertEqual(spec.validate(frame, b"\x01\x02\x03\x04"), [1, 2, 3, 4])
+        self.assertEqual(spec.validate(frame, range(1, 5)), [1, 2, 3, 4])
         self.assertRaises(TypeError, spec.validate, frame, 1)
         self.assertRaises(TypeError, spec.validate, frame, "1234")
         self.assertRaises(ValueError, spec.validate, frame, [1, 2, 3])
@@ -512,6 +538,39 @@ class SpecTestCase(unittest.TestCase):
         self.assertRaises(ValueError, spec.validate, frame, "foobar")
         self.assertRaises(TypeError, spec.validate, frame, 1.5)
 
+        # spec.to_str
+        self.assertEqual(spec.to_str(3), "Front Cover(3)")
+        self.assertEqual(spec.to_str(21), "Unknown(21)")
+        self.assertEqual(spec.to_str(None), "Unknown(None)")
+
+    def testReadAt(self):
+        frame = TextFrame(frameid="TEST", encoding=1)
+        data = b"\xff\xfeF\x00o\x00o\x00\x00\x00\xff\xfeB\x00a\x00r\x00"
+        for spec in (ByteSpec("test"), IntegerSpec("test", 16),
+                     SignedIntegerSpec("test", 24), VarIntSpec("test"),
+                     BinaryDataSpec("test"), NullTerminatedStringSpec("test"),
+                     EncodedStringSpec("test"),
+                     SequenceSpec("test", EncodedStringSpec("test"))):
+            for offset in range(0, 4):
+                try:
+                    value, rest = spec.read(frame, data[offset:])
+                except EOFError:
+                    self.assertRaises(EOFError, spec.read_at, frame, data, offset)
+                    continue
+                self.assertEqual(spec.read_at(frame, data, offset),
+                                 (value, len(data) - len(rest)))
+        self.assertEqual(SequenceSpec("test", EncodedStringSpec("test"))
+                         .read_at(frame, data, 0), (["Foo", "Bar"], len(data)))
+
+        # Subclasses that only override read still have it called.
+        class PlusOneSpec(ByteSpec):
+            def read(self, frame, data):
+                value, data = super().read(frame, data)
+                return value + 1, data
+        spec = PlusOneSpec("test")
+        self.assertEqual(spec.read_at(frame, b"\x01\x02\x03", 1), (3, 2))
+        spec = SequenceSpec("test", PlusOneSpec("test"))
+        self.assertEqual(spec.read_at(frame, b"\x01\x02\x03", 1), ([3, 4], 3))
         
 suite = unittest.TestLoader().loadTestsFromTestCase(SpecTestCase)
 
@@ -243,6 +243,79 @@ class TagTestCase(unittest.TestCase):
             self.assertEqual(ws[0].message.args, ("TIT2: Stripped 13 empty strings "
                              "from end of frame",))
 
+    def testSkipBozo(self):
+        for cls in (stagger.Tag23, stagger.Tag24):
+            tag = cls()
+            tag[TIT2] = "Foobar"
+            tag[SYTC] = SYTC(format=1, data=b"\x00\x01\x02")
+            data = tag.encode()
+            dtag = stagger.decode_tag(data, skip_bozo=True)
+            self.assertEqual(dtag[TIT2].text, ["Foobar"])
+            self.assertTrue(type(dtag["SYTC"]) is stagger.UnknownFrame)
+            self.assertEqual(dtag["SYTC"].data, b"\x01\x00\x01\x02")
+            self.assertEqual(stagger.decode_tag(data)[SYTC], tag[SYTC])
+
+    def testFrameFilter(self):
+        for cls in (stagger.Tag22, stagger.Tag23, stagger.Tag24):
+            for unsync in (False, True):
+                tag = cls()
+                if unsync:
+                    tag.flags.add("unsynchronised")
+                tag.title = "Foo\xff"
+                tag.artist = "Bar"
+                tag.album = "Baz"
+                data = tag.encode()
+                title = "TT2" if cls is stagger.Tag22 else "TIT2"
+                dtag = stagger.decode_tag(data, exclude=[title])
+                self.assertEqual(dtag.title, "")
+                self.assertEqual(dtag.artist, "Bar")
+                self.assertEqual(dtag.album, "Baz")
+                dtag = stagger.decode_tag(data, include=[title])
+                self.assertEqual(dtag.title, "Foo\xff")
+                self.assertEqual(len(dtag), 1)
+                dtag = stagger.decode_tag(data, include=[title], 
+                                          exclude=[title])
+                self.assertEqual(len(dtag), 0)
+                # A single frame id may be given as a plain string
+                dtag = stagger.decode_tag(data, include=title)
+                self.assertEqual(dtag.title, "Foo\xff")
+                self.assertEqual(len(dtag), 1)
+                dtag = stagger.decode_tag(data, exclude=title)
+                self.assertEqual(dtag.title, "")
+                self.assertEqual(len(dtag), 2)
+
+    def testLastFrameOverrunsTag(self):
+        for cls in (stagger.Tag22, stagger.Tag23, stagger.Tag24):
+            tag = cls()
+            tag.padding_default = 0
+            tag.title = "Foo"
+            tag.artist = "Bar"
+            tag.album = "Baz"
+            data = bytearray(tag.encode())
+            # Declare a tag size that cuts into the last frame
+            data[6:10] = stagger.conversion.Syncsafe.encode(len(data) - 12,
+                                                            width=4)
+            dtag = stagger.decode_tag(bytes(data))
+            self.assertEqual(len(dtag), 3)
+
+    def testPICUpgrade(self):
+        # PIC frames with formats other than JPG/PNG get their MIME type
+        # from the image data when converted to APIC.
+        gif = b"GIF89a" + bytes(40)
+        tag = stagger.Tag24()
+        tag[PIC] = [PIC(format="GIF", type=3, desc="", data=gif)]
+        dtag = stagger.decode_tag(tag.encode())
+        self.assertEqual(dtag[APIC][0].mime, "image/gif")
+        self.assertEqual(dtag[APIC][0].data, gif)
+
+        tag[PIC] = [PIC(format="XYZ", type=3, desc="", data=bytes(40))]
+        with warnings.catch_warnings(record=True) as ws:
+            warnings.simplefilter("always")
+            data = tag.encode()
+            self.assertEqual(len(ws), 1)
+            self.assertEqual(ws[0].category, stagger.FrameWarning)
+        self.assertTrue(APIC not in stagger.decode_tag(data))
+
 suite = unittest.TestLoader().loadTestsFromTestCase(TagTestCase)
 
 if __name__ == "__main__":